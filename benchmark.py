@@ -0,0 +1,185 @@
+# Copyright 2018, National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS).  Under the terms of Contract DE-NA0003525 with NTESS, the U.S.
+# Government retains certain rights in this software.
+
+"""Benchmarks deep visualization extraction and generation, using synthetic images and randomly initialized models.
+
+Runs entirely offline, timing each phase of :func:`samlab.deepvis.generate`
+separately and writing the results as JSON, which can be compared against a
+previous run with --compare.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import PIL.Image
+import numpy
+import torch
+import torchvision.datasets
+import torchvision.models
+import torchvision.transforms.v2
+
+import samlab
+import samlab.deepvis
+
+
+parser = argparse.ArgumentParser(description="Benchmark deep visualization generation.")
+parser.add_argument("--batch-size", type=int, default=32, help="Batch size for evaluation. Default: %(default)s")
+parser.add_argument("--classes", type=int, default=4, help="Number of synthetic image categories. Default: %(default)s")
+parser.add_argument("--compare", help="Compare phase timings against the results of a previous run. Default: no comparison")
+parser.add_argument("--correlations", action="store_true", help="Accumulate the covariance of each layer's channels.")
+parser.add_argument("--count", type=int, default=128, help="Number of synthetic images. Default: %(default)s")
+parser.add_argument("--device", default="cpu", help="PyTorch device to use for evaluation. Default: %(default)s")
+parser.add_argument("--examples", type=int, default=10, help="Number of examples to display for each channel. Default: %(default)s")
+parser.add_argument("--image-size", type=int, default=256, help="Size of the synthetic images in pixels. Default: %(default)s")
+parser.add_argument("--jobs", type=int, default=1, help="Number of worker processes for site generation. Default: %(default)s")
+parser.add_argument("--mode", choices=["pages", "shards"], default="pages", help="Generate static pages, or data shards for a client-side viewer. Default: %(default)s")
+parser.add_argument("--model", choices=["mobilenet_v3_small", "resnet18", "squeezenet1_1"], default="squeezenet1_1", help="Randomly initialized model to analyze. Default: %(default)s")
+parser.add_argument("--neighbors", type=int, default=0, help="Number of similar samples to find for each sample and layer. Default: %(default)s")
+parser.add_argument("--output", help="Write results to a file. Default: standard output")
+parser.add_argument("--repeat", type=int, default=3, help="Number of times to generate the site. Default: %(default)s")
+parser.add_argument("--scan", action="store_true", help="Scan every sample for its category, instead of reading them from the dataset metadata.")
+parser.add_argument("--seed", type=int, default=1234, help="Random seed. Default: %(default)s")
+parser.add_argument("--spatial", action="store_true", help="Generate receptive field crops and heatmap overlays.")
+parser.add_argument("--sprites", action="store_true", help="Combine each channel's thumbnails into sprite sheets.")
+parser.add_argument("--statistics", action="store_true", help="Compute streaming statistics for every channel.")
+parser.add_argument("--streaming", action="store_true", help="Keep only the top activations for each channel and sample.")
+parser.add_argument("--tolerance", type=float, default=0.2, help="Fraction a phase may slow down before --compare reports a regression. Default: %(default)s")
+parser.add_argument("--workers", type=int, default=0, help="Number of data loading worker processes. Default: %(default)s")
+
+phases = ["scan", "receptivefields", "cache", "forward", "topk", "correlations", "neighbors", "images", "assets", "render", "manifest"]
+
+
+def main():
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        # Generate smooth random images, which compress and decode like photographs rather than noise.
+        generator = numpy.random.default_rng(arguments.seed)
+        for index in range(arguments.count):
+            category = index % arguments.classes
+            os.makedirs(os.path.join(tempdir, "images", f"category-{category}"), exist_ok=True)
+            pixels = generator.integers(0, 256, size=(8, 8, 3), dtype=numpy.uint8)
+            image = PIL.Image.fromarray(pixels).resize((arguments.image_size, arguments.image_size), PIL.Image.BICUBIC)
+            image.save(os.path.join(tempdir, "images", f"category-{category}", f"{index:06d}.jpg"), quality=90)
+
+        evaluate = samlab.deepvis.Pipeline(torchvision.datasets.ImageFolder(os.path.join(tempdir, "images")))
+        view = torchvision.datasets.ImageFolder(
+            os.path.join(tempdir, "images"),
+            transform=torchvision.transforms.v2.Compose([
+                torchvision.transforms.v2.CenterCrop((224, 224)),
+                lambda x: (x,),
+                ]),
+            target_transform=samlab.deepvis.map_classes(evaluate.dataset.classes),
+            )
+
+        # Randomly initialized weights avoid downloads, and cost the same to evaluate as trained weights.
+        torch.manual_seed(arguments.seed)
+        model = getattr(torchvision.models, arguments.model)(weights=None)
+        model.eval()
+
+        runs = []
+        for run in range(arguments.repeat):
+            dataset = samlab.deepvis.Namespace(
+                name="Synthetic",
+                slug="synthetic",
+                classnames=evaluate.dataset.classes,
+                evaluate=evaluate,
+                view=view,
+                )
+            if not arguments.scan:
+                dataset.targets = evaluate.dataset.targets
+
+            profile = {}
+            start = time.perf_counter()
+            samlab.deepvis.generate(
+                batchsize=arguments.batch_size,
+                channelnames={},
+                clean=True,
+                correlations=arguments.correlations,
+                datasets=[dataset],
+                device=torch.device(arguments.device),
+                examples=arguments.examples,
+                jobs=arguments.jobs,
+                mode=arguments.mode,
+                model=model,
+                neighbors=arguments.neighbors,
+                profile=profile,
+                spatial=arguments.spatial,
+                sprites=arguments.sprites,
+                statistics=arguments.statistics,
+                streaming=arguments.streaming,
+                targetdir=os.path.join(tempdir, "site"),
+                title=f"Benchmark {arguments.model}",
+                webroot="/",
+                workers=arguments.workers,
+                )
+            total = time.perf_counter() - start
+
+            # Measure the generated site.
+            files = 0
+            size = 0
+            for root, dirnames, filenames in os.walk(os.path.join(tempdir, "site")):
+                for filename in filenames:
+                    files += 1
+                    size += os.path.getsize(os.path.join(root, filename))
+
+            phasetimes = {phase: profile["phases"].get(phase, {}).get("seconds", 0.0) for phase in phases}
+            phasetimes["other"] = max(0.0, total - sum(phasetimes.values()))
+            runs.append({"bytes": size, "files": files, "peakrss": profile["total"]["peakrss"], "phases": phasetimes, "samplespersecond": arguments.count / total, "total": total})
+
+    results = {
+        "benchmark": {key: value for key, value in vars(arguments).items() if key not in ["compare", "output", "tolerance"]},
+        "environment": {
+            "cpus": os.cpu_count(),
+            "numpy": numpy.__version__,
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "samlab": samlab.__version__,
+            "torch": torch.__version__,
+            "torchvision": torchvision.__version__,
+            },
+        "median": {
+            "phases": {phase: statistics.median(run["phases"][phase] for run in runs) for phase in runs[0]["phases"]},
+            "total": statistics.median(run["total"] for run in runs),
+            },
+        "runs": runs,
+        }
+
+    if arguments.output:
+        with open(arguments.output, "w") as stream:
+            json.dump(results, stream, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    # Optionally report phases that slowed down relative to a previous run.
+    if arguments.compare:
+        with open(arguments.compare) as stream:
+            baseline = json.load(stream)
+        if baseline["benchmark"] != results["benchmark"]:
+            sys.stderr.write("Warning: benchmark options differ from the baseline.\n")
+
+        regressions = []
+        for phase, elapsed in sorted(results["median"]["phases"].items()) + [("total", results["median"]["total"])]:
+            previous = baseline["median"]["total"] if phase == "total" else baseline["median"]["phases"].get(phase, 0.0)
+            ratio = elapsed / previous if previous else float("inf") if elapsed else 1.0
+            # Ignore phases too short to time reliably.
+            regressed = ratio > 1 + arguments.tolerance and elapsed - previous > 0.05
+            if regressed:
+                regressions.append(phase)
+            sys.stderr.write(f"{phase:>16} {previous:9.3f}s {elapsed:9.3f}s {ratio:7.2f}x{' regression' if regressed else ''}\n")
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
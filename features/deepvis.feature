@@ -0,0 +1,58 @@
+Feature: Deep visualization
+
+    Scenario Outline: Sharded activations
+        Given a synthetic image folder with 24 images.
+        And a randomly initialized model.
+        When activations are computed in <count> shards with <options>, and merged.
+        Then the merged activations must match an unsharded run with <options>.
+
+        Examples:
+            | count | options                                                       |
+            | 2     | {}                                                            |
+            | 8     | {}                                                            |
+            | 2     | {"streaming": true}                                           |
+            | 8     | {"streaming": true}                                           |
+            | 8     | {"correlations": true, "statistics": true}                    |
+            | 8     | {"correlations": true, "statistics": true, "streaming": true} |
+
+    Scenario: Channel rankings
+        Given a synthetic image folder with 24 images.
+        And a randomly initialized model.
+        Then full and streaming mode must select the same samples for every channel.
+
+    Scenario: Regenerating an unchanged site
+        Given a synthetic image folder with 24 images.
+        And a randomly initialized model.
+        When a site is generated with {}.
+        And the site is generated again with {}.
+        Then the second run must write no files.
+
+    Scenario: Resuming an interrupted run
+        Given a synthetic image folder with 24 images.
+        And a randomly initialized model.
+        When a site generated with {} is interrupted after 100 files.
+        And the site is generated again with {}.
+        Then the second run must reuse files from the first.
+        And the site must match a site generated in one run with {}.
+
+    Scenario: Replacing an image
+        Given a synthetic image folder with 24 images.
+        And a randomly initialized model.
+        And a shared image store.
+        When a site is generated with {}.
+        And an image is replaced.
+        And the site is generated again with {}.
+        Then the site must match a site generated in one run with {}.
+
+    Scenario: Removing layers
+        Given a synthetic image folder with 24 images.
+        And a randomly initialized model.
+        When a site is generated with {}.
+        And the site is generated again with {"layers": ["features.*"]}.
+        Then the site must match a site generated in one run with {"layers": ["features.*"]}.
+
+    Scenario: Generating with several jobs
+        Given a synthetic image folder with 24 images.
+        And a randomly initialized model.
+        When a site is generated with {"jobs": 2}.
+        Then the site must match a site generated in one run with {"jobs": 1}.
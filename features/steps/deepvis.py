@@ -0,0 +1,206 @@
+# Copyright 2018, National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS).  Under the terms of Contract DE-NA0003525 with NTESS, the U.S.
+# Government retains certain rights in this software.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest.mock
+
+import numpy
+import PIL.Image
+import torch
+import torchvision.models
+
+from behave import *
+
+from samlab import deepvis
+
+
+class Interrupted(Exception):
+    pass
+
+
+def create_context(context, options, **kwargs):
+    return deepvis.createcontext(
+        batchsize=8,
+        channelnames={},
+        datasets=create_datasets(context),
+        device=torch.device("cpu"),
+        examples=5,
+        model=context.model,
+        title="Test",
+        webroot="/",
+        **options,
+        **kwargs,
+        )
+
+
+def create_datasets(context):
+    # Datasets are annotated by createcontext, so each context gets its own.
+    generator = torch.Generator()
+    generator.manual_seed(1234)
+    return [deepvis.imagefolder(context.images, None, generator)]
+
+
+def generate_site(context, targetdir, options, **kwargs):
+    # Every run is profiled, so the home page links to the profile the same way, and steps can check what was written.
+    context.profile = {}
+    deepvis.generate(
+        batchsize=8,
+        channelnames={},
+        clean=False,
+        datasets=create_datasets(context),
+        device=torch.device("cpu"),
+        examples=5,
+        model=context.model,
+        profile=context.profile,
+        targetdir=targetdir,
+        title="Test",
+        webroot="/",
+        **options,
+        **kwargs,
+        )
+
+
+def site_files(targetdir):
+    # The manifest records modification times, and profiles record timings, so neither is compared.
+    files = {}
+    for directory, subdirectories, filenames in os.walk(targetdir):
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(directory, filename), targetdir)
+            if path == "manifest.jsonl" or path.startswith("profile" + os.sep):
+                continue
+            with open(os.path.join(directory, filename), "rb") as stream:
+                files[path] = stream.read()
+    return files
+
+
+@given(u'a synthetic image folder with {count:d} images.')
+def step_impl(context, count):
+    context.images = tempfile.mkdtemp()
+    context.add_cleanup(shutil.rmtree, context.images)
+    generator = numpy.random.default_rng(1234)
+    for index in range(count):
+        directory = os.path.join(context.images, f"class-{index % 3}")
+        os.makedirs(directory, exist_ok=True)
+        PIL.Image.fromarray(generator.integers(0, 256, (64, 64, 3), dtype=numpy.uint8)).save(os.path.join(directory, f"{index}.png"))
+
+
+@given(u'a randomly initialized model.')
+def step_impl(context):
+    torch.manual_seed(1234)
+    context.model = torchvision.models.squeezenet1_1(weights=None, num_classes=3)
+
+
+@given(u'a shared image store.')
+def step_impl(context):
+    context.store = tempfile.mkdtemp()
+    context.add_cleanup(shutil.rmtree, context.store)
+
+
+@when(u'activations are computed in {count:d} shards with {options}, and merged.')
+def step_impl(context, count, options):
+    context.cachedir = tempfile.mkdtemp()
+    context.add_cleanup(shutil.rmtree, context.cachedir)
+    for index in range(count):
+        create_context(context, json.loads(options), cachedir=context.cachedir, shard=(index, count))
+    deepvis.merge(context.cachedir)
+    context.merged = create_context(context, json.loads(options), cachedir=context.cachedir)
+
+
+@then(u'the merged activations must match an unsharded run with {options}.')
+def step_impl(context, options):
+    unsharded = create_context(context, json.loads(options))
+    fields = ["values", "channelvalues", "channelsamples", "samplevalues", "samplechannels"] + deepvis._statisticsfields + deepvis._covariancefields
+    for merged, expected in zip(context.merged.model.layers, unsharded.model.layers):
+        for field in fields:
+            a, b = getattr(merged.activations[0], field, None), getattr(expected.activations[0], field, None)
+            if a is None and b is None:
+                continue
+            # Sharding regroups the merges of running statistics, which only changes their rounding.
+            torch.testing.assert_close(a, b, msg=lambda message: f"{merged.name} {field}: {message}")
+
+
+@then(u'full and streaming mode must select the same samples for every channel.')
+def step_impl(context):
+    full = create_context(context, {})
+    streaming = create_context(context, {"streaming": True})
+    for a, b in zip(full.model.layers, streaming.model.layers):
+        # Dead channels tie on every sample, so this also checks that ties are broken the same way.
+        torch.testing.assert_close(a.activations[0].channelsamples, b.activations[0].channelsamples, msg=lambda message: f"{a.name}: {message}")
+        torch.testing.assert_close(a.activations[0].channelvalues, b.activations[0].channelvalues, msg=lambda message: f"{a.name}: {message}")
+
+
+@when(u'a site is generated with {options}.')
+def step_impl(context, options):
+    context.site = tempfile.mkdtemp()
+    context.add_cleanup(shutil.rmtree, context.site)
+    generate_site(context, context.site, json.loads(options), store=getattr(context, "store", None))
+
+
+@when(u'a site generated with {options} is interrupted after {count:d} files.')
+def step_impl(context, options, count):
+    context.site = tempfile.mkdtemp()
+    context.add_cleanup(shutil.rmtree, context.site)
+
+    # Stop partway through writing images and pages, as if the process had been killed.
+    written = []
+
+    def interrupt(fn):
+        def wrapper(*args, **kwargs):
+            if len(written) == count:
+                raise Interrupted()
+            written.append(args[1])
+            return fn(*args, **kwargs)
+        return wrapper
+
+    with unittest.mock.patch.object(deepvis, "_writefile", interrupt(deepvis._writefile)), unittest.mock.patch.object(deepvis, "_writestream", interrupt(deepvis._writestream)):
+        try:
+            generate_site(context, context.site, json.loads(options))
+        except Interrupted:
+            pass
+        else:
+            raise AssertionError("The run finished before it was interrupted.")
+
+
+@when(u'an image is replaced.')
+def step_impl(context):
+    # The modification time is moved forward explicitly, since filesystem timestamps can be coarse.
+    path = os.path.join(context.images, "class-0", "0.png")
+    stat = os.stat(path)
+    generator = numpy.random.default_rng(5678)
+    PIL.Image.fromarray(generator.integers(0, 256, (64, 64, 3), dtype=numpy.uint8)).save(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+
+@when(u'the site is generated again with {options}.')
+def step_impl(context, options):
+    generate_site(context, context.site, json.loads(options), store=getattr(context, "store", None))
+
+
+@then(u'the second run must write no files.')
+def step_impl(context):
+    if context.profile["total"]["files"]:
+        raise AssertionError(f"Wrote {context.profile['total']['files']} files.")
+
+
+@then(u'the second run must reuse files from the first.')
+def step_impl(context):
+    if not sum(stats["unchanged"] for stats in context.profile["phases"].values()):
+        raise AssertionError("No files were reused.")
+
+
+@then(u'the site must match a site generated in one run with {options}.')
+def step_impl(context, options):
+    # The expected site doesn't share the image store, so stale store objects can't hide in both sites.
+    expected = tempfile.mkdtemp()
+    context.add_cleanup(shutil.rmtree, expected)
+    generate_site(context, expected, json.loads(options))
+    actual, expected = site_files(context.site), site_files(expected)
+    if actual.keys() != expected.keys():
+        raise AssertionError(f"Extra files: {sorted(actual.keys() - expected.keys())[:10]}, missing files: {sorted(expected.keys() - actual.keys())[:10]}")
+    different = sorted(path for path in actual if actual[path] != expected[path])
+    if different:
+        raise AssertionError(f"{len(different)} files differ: {different[:10]}")
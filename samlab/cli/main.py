@@ -10,38 +10,81 @@ import logging
 import os
 import sys
 
-import torch.utils.data
-import torchvision.datasets
-import torchvision.models
-import torchvision.transforms.v2
-
+# Heavy dependencies are imported by the commands that use them, so other commands start quickly.
 import samlab
-import samlab.deepvis
 
 
 # Setup the command line user interface.
 parser = argparse.ArgumentParser(description="SAMLAB tools.")
 subparsers = parser.add_subparsers(title="commands (choose one)", dest="command")
 
+# Options shared by commands that analyze a model.
+model_parser = argparse.ArgumentParser(add_help=False)
+model_parser.add_argument("--batch-size", type=int, default=64, help="Batch size for evaluation. Default: %(default)s")
+model_parser.add_argument("--cache", help="Directory for caching activations between runs. Default: no caching")
+model_parser.add_argument("--caltech", action="store_true", help="Use Caltech 101 for testing.")
+model_parser.add_argument("--caltech-count", type=int, help="Number of Caltech 101 images to use for testing. Default: all")
+model_parser.add_argument("--caltech-path", help="Specify the path to the Caltech 101 classification dataset.")
+model_parser.add_argument("--channels-last", action="store_true", help="Use the channels-last memory format for evaluation.")
+model_parser.add_argument("--correlation-layers", nargs="+", help="Shell-style patterns selecting the layers used with --correlations, where a leading ! excludes matching layers. Default: all analyzed layers")
+model_parser.add_argument("--correlations", action="store_true", help="Accumulate the covariance of each layer's channels, and show the most correlated channels on layer and channel pages.")
+model_parser.add_argument("--dataset", nargs=2, action="append", metavar=("SOURCE", "PATH"), help="Use a dataset from a source (caltech101, imagefolder, imagenet2012, places365, or tarshards) for testing, e.g. an image folder or a glob pattern matching tar shards.  May be repeated.")
+model_parser.add_argument("--dataset-count", type=int, help="Number of images to use from each --dataset source. Default: all")
+model_parser.add_argument("--dataset-name", action="append", help="Name for the corresponding --dataset, in order, which also determines its URLs.  May be repeated.  Default: derived from the path")
+model_parser.add_argument("--device", default="cpu", help="PyTorch device to use for evaluation. Default: %(default)s")
+model_parser.add_argument("--examples", type=int, default=100, help="Number of examples to display for each channel. Default: %(default)s")
+model_parser.add_argument("--imagenet", action="store_true", help="Use ImageNet 2012 for testing.")
+model_parser.add_argument("--imagenet-count", type=int, help="Number of ImageNet 2012 images to use for testing. Default: all")
+model_parser.add_argument("--imagenet-path", help="Specify the path to the ImageNet 2012 classification dataset.")
+model_parser.add_argument("--layers", nargs="+", help="Shell-style patterns selecting the layers to analyze, where a leading ! excludes matching layers. Default: all layers")
+model_parser.add_argument("--neighbor-dims", type=int, default=64, help="Compress activations to this many dimensions with a random projection before finding similar samples, or 0 to compare them uncompressed. Default: %(default)s")
+model_parser.add_argument("--neighbor-layers", nargs="+", help="Shell-style patterns selecting the layers used to find similar samples, where a leading ! excludes matching layers. Default: all analyzed layers")
+model_parser.add_argument("--neighbors", type=int, default=0, help="Number of similar samples to list on each sample page, for each layer. Default: %(default)s")
+model_parser.add_argument("--overlap", action="store_true", help="Reduce and accumulate activations in the background, overlapped with evaluation.")
+model_parser.add_argument("--places", action="store_true", help="Use Places365 for testing.")
+model_parser.add_argument("--places-count", type=int, help="Number of Places365 images to use for testing. Default: all")
+model_parser.add_argument("--places-path", help="Specify the path to the Places365 classification dataset.")
+model_parser.add_argument("--precision", choices=["fp32", "bf16"], default="fp32", help="Numeric precision for evaluation. Default: %(default)s")
+model_parser.add_argument("--prefetch", type=int, default=2, help="Number of batches loaded in advance by each worker. Default: %(default)s")
+model_parser.add_argument("--seed", type=int, default=1234, help="Random seed. Default: %(default)s")
+model_parser.add_argument("--statistics", action="store_true", help="Compute streaming statistics, histograms, and quantiles for every channel, and show them on layer and channel pages.")
+model_parser.add_argument("--streaming", action="store_true", help="Keep only the top activations for each channel and sample, instead of every activation.")
+model_parser.add_argument("--thumbnail-format", choices=["webp", "jpeg"], default="webp", help="Image format for thumbnails. Default: %(default)s")
+model_parser.add_argument("--thumbnail-quality", type=int, default=80, help="Image quality for thumbnails. Default: %(default)s")
+model_parser.add_argument("--thumbnail-size", type=int, default=96, help="Maximum thumbnail size in pixels. Default: %(default)s")
+model_parser.add_argument("--workers", type=int, default=0, help="Number of data loading worker processes. Default: %(default)s")
+model_parser.add_argument("model", choices=["vgg19", "resnet50", "inceptionv1"], help="Model to analyze.")
+
 # deepvis
-deepvis_subparser = subparsers.add_parser("deepvis", help="Generate a deep visualization website.")
-deepvis_subparser.add_argument("--batch-size", type=int, default=64, help="Batch size for evaluation. Default: %(default)s")
-deepvis_subparser.add_argument("--caltech", action="store_true", help="Use Caltech 101 for testing.")
-deepvis_subparser.add_argument("--caltech-count", type=int, help="Number of Caltech 101 images to use for testing. Default: all")
-deepvis_subparser.add_argument("--caltech-path", help="Specify the path to the Caltech 101 classification dataset.")
+deepvis_subparser = subparsers.add_parser("deepvis", parents=[model_parser], help="Generate a deep visualization website.")
+deepvis_subparser.add_argument("--bundle", help="Also pack the generated site into a single zip archive, which can be served with the serve-bundle command. Default: no bundle")
 deepvis_subparser.add_argument("--clean", action="store_true", help="Delete the target directory before generating.")
-deepvis_subparser.add_argument("--device", default="cpu", help="PyTorch device to use for evaluation. Default: %(default)s")
-deepvis_subparser.add_argument("--examples", type=int, default=100, help="Number of examples to display for each channel. Default: %(default)s")
-deepvis_subparser.add_argument("--imagenet", action="store_true", help="Use ImageNet 2012 for testing.")
-deepvis_subparser.add_argument("--imagenet-count", type=int, help="Number of ImageNet 2012 images to use for testing. Default: all")
-deepvis_subparser.add_argument("--imagenet-path", help="Specify the path to the ImageNet 2012 classification dataset.")
-deepvis_subparser.add_argument("--places", action="store_true", help="Use Places365 for testing.")
-deepvis_subparser.add_argument("--places-count", type=int, help="Number of Places365 images to use for testing. Default: all")
-deepvis_subparser.add_argument("--places-path", help="Specify the path to the Places365 classification dataset.")
-deepvis_subparser.add_argument("--seed", type=int, default=1234, help="Random seed. Default: %(default)s")
-deepvis_subparser.add_argument("model", choices=["vgg19", "resnet50", "inceptionv1"], help="Model to analyze.")
+deepvis_subparser.add_argument("--jobs", type=int, default=1, help="Number of worker processes for site generation. Default: %(default)s")
+deepvis_subparser.add_argument("--mode", choices=["pages", "shards"], default="pages", help="Generate static pages, or data shards for a client-side viewer. Default: %(default)s")
+deepvis_subparser.add_argument("--profile", action="store_true", help="Record the time, throughput, output, and memory use of each phase, writing a report and summary page to the target directory.")
+deepvis_subparser.add_argument("--shard", help="Only compute activations for shard I/N of each dataset, saving them to the cache for the merge command. Default: no sharding")
+deepvis_subparser.add_argument("--spatial", action="store_true", help="Keep heatmaps for each channel's top samples, and add receptive field crops and heatmap overlays to channel pages.")
+deepvis_subparser.add_argument("--sprites", action="store_true", help="Combine the thumbnails on each channel page into sprite sheets.")
+deepvis_subparser.add_argument("--store", help="Directory for storing sample images once, shared by every site that uses them, and hard linked into the target directory. Default: no store")
+deepvis_subparser.add_argument("--trace", action="store_true", help="Capture a torch.profiler trace of the forward pass in the target directory.")
 deepvis_subparser.add_argument("output", help="Target directory to receive results.")
 
+# merge
+merge_subparser = subparsers.add_parser("merge", help="Combine sharded activations in a cache directory.")
+merge_subparser.add_argument("cache", help="Directory containing cached activations.")
+
+# serve
+serve_subparser = subparsers.add_parser("serve", parents=[model_parser], help="Serve a deep visualization website, rendering pages on demand.")
+serve_subparser.add_argument("--host", default="localhost", help="Host address to listen on. Default: %(default)s")
+serve_subparser.add_argument("--lru-size", type=int, default=256, help="Maximum size of the in-memory cache of rendered pages and images, in MiB. Default: %(default)s")
+serve_subparser.add_argument("--port", type=int, default=8000, help="Port to listen on. Default: %(default)s")
+
+# serve-bundle
+serve_bundle_subparser = subparsers.add_parser("serve-bundle", help="Serve a deep visualization website from a bundle created with deepvis --bundle.")
+serve_bundle_subparser.add_argument("--host", default="localhost", help="Host address to listen on. Default: %(default)s")
+serve_bundle_subparser.add_argument("--port", type=int, default=8000, help="Port to listen on. Default: %(default)s")
+serve_bundle_subparser.add_argument("bundle", help="Bundle to serve.")
+
 # version
 version_subparser = subparsers.add_parser("version", help="Print the Samlab version.")
 
@@ -56,57 +99,167 @@ def main():
     log = logging.getLogger()
     log.name = os.path.basename(sys.argv[0])
 
-    generator = torch.Generator()
-    generator.manual_seed(arguments.seed)
+    # Validate the shard before loading the model.
+    shard = None
+    if arguments.command == "deepvis" and arguments.shard:
+        try:
+            shard = tuple(int(part) for part in arguments.shard.split("/"))
+        except ValueError:
+            shard = ()
+        if len(shard) != 2 or not 0 <= shard[0] < shard[1]:
+            parser.error(f"Invalid shard: {arguments.shard}.  Use I/N, with 0 <= I < N.")
+        if not arguments.cache:
+            parser.error("--shard requires --cache, which receives the sharded activations for the merge command.")
 
-    # deepvis
-    if arguments.command == "deepvis":
-        match arguments.model:
-            case "vgg19":
-                title = "VGG-19"
-                model = torchvision.models.vgg19(weights="IMAGENET1K_V1")
-                imagenet = torchvision.datasets.ImageNet(arguments.imagenet_path)
-                channelnames = {"classifier.6": [classes[0] for classes in imagenet.classes]}
-            case "resnet50":
-                title = "ResNet-50"
-                model = torchvision.models.resnet50(weights="IMAGENET1K_V2")
-                channelnames = {}
-            case "inceptionv1":
-                title = "Inception v1"
-                model = torchvision.models.googlenet(weights="IMAGENET1K_V1")
-                channelnames = {}
-            case _:
-                raise NotImplementedError(f"Unsupported model: {arguments.model}")
+    # deepvis, serve
+    if arguments.command in ["deepvis", "serve"]:
+        import torch
+        import torchvision.models
+
+        from samlab import deepvis
+
+        generator = torch.Generator()
+        generator.manual_seed(arguments.seed)
 
+        # Datasets are created first, so problems with them are reported before loading the model.
         datasets = []
 
         # Optionally use Caltech 101 for testing.
         if arguments.caltech:
-            datasets.append(samlab.deepvis.caltech101(arguments.caltech_path, arguments.caltech_count, generator))
+            datasets.append(deepvis.caltech101(arguments.caltech_path, arguments.caltech_count, generator))
 
 
         # Optionally use ImageNet for testing.
         if arguments.imagenet:
-            datasets.append(samlab.deepvis.imagenet2012(arguments.imagenet_path, arguments.imagenet_count, generator))
+            datasets.append(deepvis.imagenet2012(arguments.imagenet_path, arguments.imagenet_count, generator))
 
         # Optionally use Places365 for testing.
         if arguments.places:
-            datasets.append(samlab.deepvis.places365(arguments.places_path, arguments.places_count, generator))
+            datasets.append(deepvis.places365(arguments.places_path, arguments.places_count, generator))
 
+        # Optionally use datasets from other sources.
+        names = arguments.dataset_name or []
+        if len(names) > len(arguments.dataset or []):
+            parser.error("There are more --dataset-name options than --dataset options.")
+        for index, (source, path) in enumerate(arguments.dataset or []):
+            if source not in deepvis.sources:
+                parser.error(f"Unknown dataset source: {source}.  Choose from {', '.join(sorted(deepvis.sources))}.")
+            datasets.append(deepvis.sources[source](path, arguments.dataset_count, generator, name=names[index] if index < len(names) else None))
+
+        # Each dataset's pages are stored under its slug.
+        slugs = {}
+        for dataset in datasets:
+            if dataset.slug in slugs:
+                parser.error(f"Datasets {slugs[dataset.slug]} and {dataset.name} would both be stored as {dataset.slug}.  Name them with --dataset-name.")
+            slugs[dataset.slug] = dataset.name
+
+        match arguments.model:
+            # Class names for the output layers come from the weights metadata, without loading a dataset.
+            case "vgg19":
+                title = "VGG-19"
+                weights = torchvision.models.VGG19_Weights.IMAGENET1K_V1
+                model = torchvision.models.vgg19(weights=weights)
+                channelnames = {"classifier.6": weights.meta["categories"]}
+            case "resnet50":
+                title = "ResNet-50"
+                weights = torchvision.models.ResNet50_Weights.IMAGENET1K_V2
+                model = torchvision.models.resnet50(weights=weights)
+                channelnames = {"fc": weights.meta["categories"]}
+            case "inceptionv1":
+                title = "Inception v1"
+                weights = torchvision.models.GoogLeNet_Weights.IMAGENET1K_V1
+                model = torchvision.models.googlenet(weights=weights)
+                channelnames = {"fc": weights.meta["categories"]}
+            case _:
+                raise NotImplementedError(f"Unsupported model: {arguments.model}")
+
+    # deepvis
+    if arguments.command == "deepvis":
         # Generate the website.
-        samlab.deepvis.generate(
+        deepvis.generate(
             batchsize=arguments.batch_size,
+            bundle=arguments.bundle,
+            cachedir=arguments.cache,
             channelnames=channelnames,
+            channelslast=arguments.channels_last,
             clean=arguments.clean,
+            correlationlayers=arguments.correlation_layers,
+            correlations=arguments.correlations,
             datasets=datasets,
             device=torch.device(arguments.device),
             examples=arguments.examples,
+            jobs=arguments.jobs,
+            mode=arguments.mode,
+            layers=arguments.layers,
             model=model,
+            neighbordims=arguments.neighbor_dims or None,
+            neighborlayers=arguments.neighbor_layers,
+            neighbors=arguments.neighbors,
+            overlap=arguments.overlap,
+            precision=arguments.precision,
+            prefetch=arguments.prefetch,
+            profile={} if arguments.profile else None,
+            shard=shard,
+            spatial=arguments.spatial,
+            sprites=arguments.sprites,
+            store=arguments.store,
+            statistics=arguments.statistics,
+            streaming=arguments.streaming,
             targetdir=arguments.output,
+            thumbnailformat=arguments.thumbnail_format,
+            thumbnailquality=arguments.thumbnail_quality,
+            thumbnailsize=arguments.thumbnail_size,
             title=title,
+            trace=arguments.trace,
             webroot="/",
+            workers=arguments.workers,
+            )
+
+    # merge
+    if arguments.command == "merge":
+        from samlab import deepvis
+
+        deepvis.merge(arguments.cache)
+
+    # serve
+    if arguments.command == "serve":
+        # Serve the website.
+        deepvis.serve(
+            batchsize=arguments.batch_size,
+            cachedir=arguments.cache,
+            channelnames=channelnames,
+            channelslast=arguments.channels_last,
+            correlationlayers=arguments.correlation_layers,
+            correlations=arguments.correlations,
+            datasets=datasets,
+            device=torch.device(arguments.device),
+            examples=arguments.examples,
+            host=arguments.host,
+            lrusize=arguments.lru_size * 1024 * 1024,
+            layers=arguments.layers,
+            model=model,
+            neighbordims=arguments.neighbor_dims or None,
+            neighborlayers=arguments.neighbor_layers,
+            neighbors=arguments.neighbors,
+            overlap=arguments.overlap,
+            port=arguments.port,
+            precision=arguments.precision,
+            prefetch=arguments.prefetch,
+            statistics=arguments.statistics,
+            streaming=arguments.streaming,
+            thumbnailformat=arguments.thumbnail_format,
+            thumbnailquality=arguments.thumbnail_quality,
+            thumbnailsize=arguments.thumbnail_size,
+            title=title,
+            workers=arguments.workers,
             )
 
+    # serve-bundle
+    if arguments.command == "serve-bundle":
+        from samlab import deepvis
+
+        deepvis.servebundle(arguments.bundle, host=arguments.host, port=arguments.port)
+
     # version
     if arguments.command == "version":
         print(samlab.__version__)
@@ -3,21 +3,61 @@
 # Government retains certain rights in this software.
 
 import collections
+import collections.abc
+import concurrent.futures
+import contextlib
+import copy
+import fnmatch
 import functools
+import glob
+import hashlib
+import http.server
+import io
+import itertools
+import json
 import logging
 import math
+import mimetypes
+import multiprocessing
 import os
+import posixpath
+import queue
+import re
 import shutil
+import sys
+import tarfile
+import threading
+import time
 import types
+import urllib.parse
+import zipfile
 
 import PIL.Image
+import PIL.ImageOps
 import enlighten
 import jinja2
+import numpy
 import torch.nn
+import torch.profiler
 import torchvision.transforms.v2.functional
 
 log = logging.getLogger(__name__)
 
+# Changes whenever cached activations from earlier versions would be wrong.
+_cacheversion = "2"
+# Content types that older versions of mimetypes don't know.
+_contenttypes = {".webp": "image/webp"}
+_covariancefields = ["corrcount", "corrmean", "corrcomoment"]
+_heatmapsize = 7
+_phasestack = []
+_quantiles = (0.05, 0.25, 0.5, 0.75, 0.95)
+# Activation sketches have logarithmic buckets for magnitudes from 10^-decades to 10^decades, for each sign.
+_sketchdecades = 4
+_sketchresolution = 16
+_sketchmagnitudes = 2 * _sketchdecades * _sketchresolution + 1
+_statisticsfields = ["statscount", "statsmean", "statsm2", "statszeros", "statsmin", "statsmax", "statshistogram"]
+_thumbnailextensions = {"jpeg": "jpg", "webp": "webp"}
+
 
 class Namespace(types.SimpleNamespace):
     def __init__(self, /, **kwargs):
@@ -30,19 +70,1315 @@ class Namespace(types.SimpleNamespace):
         return self.__dict__[key]
 
 
-def caltech101(path, count, generator):
-    evaluate = torchvision.datasets.Caltech101(
-        path,
-        transform=torchvision.transforms.v2.Compose([
-            torchvision.transforms.v2.ToImage(),
-            torchvision.transforms.v2.CenterCrop((224, 224)),
-            torchvision.transforms.v2.ToDtype(torch.float32, scale=True),
-            torchvision.transforms.v2.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-            lambda x: (x,),
-            ]),
+class _BackgroundStage:
+    # Runs functions in order on a background thread, with a bounded queue for backpressure.
+    def __init__(self, maxsize):
+        self._error = None
+        self._queue = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            fn, args = item
+            if self._error is None:
+                try:
+                    fn(*args)
+                except BaseException as e:
+                    self._error = e
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, fn, *args):
+        if self._error is not None:
+            raise self._error
+        self._queue.put((fn, args))
+
+
+class _Channel:
+    # Lightweight view of one channel, which becomes a plain Namespace when pickled.
+    __slots__ = ["_channels", "index"]
+
+    def __init__(self, channels, index):
+        self._channels = channels
+        self.index = index
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __reduce__(self):
+        return (functools.partial(Namespace, **self), ())
+
+    def keys(self):
+        return ["index", "name", "nexturl", "prevurl", "url"]
+
+    @property
+    def activations(self):
+        return [Namespace(
+            dataset=dataset,
+            samples=[dataset.samples[index] for index in indices[:, self.index].tolist()],
+            values=values[:, self.index].tolist(),
+            ) for dataset, indices, values in self._channels.activations]
+
+    @property
+    def correlations(self):
+        return [Namespace(
+            channels=[self._channels[index] for index in activations.corrpartners[self.index].tolist()],
+            dataset=dataset,
+            values=activations.corrpartnervalues[self.index].tolist(),
+            ) for dataset, activations in self._channels.correlations]
+
+    @property
+    def name(self):
+        names = self._channels.names
+        return names[self.index] if names is not None else f"Channel {self.index}"
+
+    @property
+    def statistics(self):
+        return [Namespace(
+            dataset=dataset,
+            **_channelstatistics(activations, self.index),
+            ) for dataset, activations in self._channels.statistics]
+
+    @property
+    def nexturl(self):
+        return f"{self._channels.url}/{(self.index + 1) % len(self._channels)}"
+
+    @property
+    def prevurl(self):
+        return f"{self._channels.url}/{(self.index - 1) % len(self._channels)}"
+
+    @property
+    def url(self):
+        return f"{self._channels.url}/{self.index}"
+
+
+class _Channels(collections.abc.Sequence):
+    # The channels of one layer, with per-dataset top-k samples stored as arrays.
+    def __init__(self, count, names, url):
+        self.activations = []
+        self.correlations = []
+        self.count = count
+        self.names = names
+        self.statistics = []
+        self.url = url
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [_Channel(self, index) for index in range(*index.indices(self.count))]
+        if not -self.count <= index < self.count:
+            raise IndexError(index)
+        return _Channel(self, index % self.count)
+
+    def __len__(self):
+        return self.count
+
+
+class _EarlyExit(Exception):
+    # Raised by forward hooks to stop evaluation after the last selected layer.
+    pass
+
+
+class _LRUCache:
+    # Thread-safe cache of (content type, content) pairs, bounded by total content size.
+    def __init__(self, maxsize):
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.maxsize = maxsize
+        self.size = 0
+
+    def get(self, key, fn):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+
+        # Compute outside the lock, so slow pages don't block other requests.
+        value = fn()
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = value
+                self.size += len(value[1])
+            while self.size > self.maxsize and len(self._items) > 1:
+                evicted, (contenttype, content) = self._items.popitem(last=False)
+                self.size -= len(content)
+        return value
+
+
+class _Sample:
+    # Lightweight view of one sample, which becomes a plain Namespace when pickled.
+    __slots__ = ["_samples", "index"]
+
+    def __init__(self, samples, index):
+        self._samples = samples
+        self.index = index
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __reduce__(self):
+        return (functools.partial(Namespace, **self), ())
+
+    def keys(self):
+        return ["category", "imageurl", "index", "name", "thumbnailurl", "url"]
+
+    @property
+    def activations(self):
+        return [Namespace(
+            layer=layer,
+            channels=[layer.channels[index] for index in indices[self.index].tolist()],
+            values=values[self.index].tolist(),
+            ) for layer, indices, values in self._samples.activations]
+
+    @property
+    def category(self):
+        index = int(self._samples.categories[self.index])
+        return Namespace(index=index, name=self._samples.classnames[index])
+
+    @property
+    def imageurl(self):
+        return f"{self._samples.url}/{self.index}/image.png"
+
+    @property
+    def name(self):
+        return f"Sample {self.index}"
+
+    @property
+    def neighbors(self):
+        return [Namespace(
+            layer=layer,
+            samples=[self._samples[index] for index in indices[self.index].tolist()],
+            values=values[self.index].tolist(),
+            ) for layer, indices, values in self._samples.neighbors]
+
+    @property
+    def thumbnailurl(self):
+        return f"{self._samples.url}/{self.index}/thumbnail.{self._samples.extension}"
+
+    @property
+    def url(self):
+        return f"{self._samples.url}/{self.index}"
+
+
+class _Samples(collections.abc.Sequence):
+    # The samples in one dataset, stored as an array of categories and a table of class names.
+    def __init__(self, categories, classnames, extension, url):
+        self.activations = []
+        self.categories = categories
+        self.classnames = classnames
+        self.extension = extension
+        self.neighbors = []
+        self.url = url
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [_Sample(self, index) for index in range(*index.indices(len(self.categories)))]
+        if not -len(self.categories) <= index < len(self.categories):
+            raise IndexError(index)
+        return _Sample(self, index % len(self.categories))
+
+    def __len__(self):
+        return len(self.categories)
+
+
+class Pipeline(torch.utils.data.Dataset):
+    """Decodes and crops each image once, returning both model inputs and the cropped image.
+
+    Wraps a dataset that returns `(PIL.Image, target)` pairs.  Each item is
+    `((x,), image, target)`, where `x` is the normalized float tensor used
+    for evaluation and `image` is the uint8 crop that is saved to the site.
+    """
+    def __init__(self, dataset, *, size=(224, 224), mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        self.dataset = dataset
+        self.size = tuple(size)
+        self.mean = list(mean)
+        self.std = list(std)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        image, target = self.dataset[index]
+        image = torchvision.transforms.v2.functional.to_image(image.convert("RGB"))
+        image = torchvision.transforms.v2.functional.center_crop(image, self.size)
+        x = torchvision.transforms.v2.functional.to_dtype(image, torch.float32, scale=True)
+        x = torchvision.transforms.v2.functional.normalize(x, mean=self.mean, std=self.std)
+        return (x,), image, target
+
+    def __repr__(self):
+        return f"Pipeline(size={self.size}, mean={self.mean}, std={self.std})"
+
+
+class TarShards(torch.utils.data.Dataset):
+    """Reads images and class labels from uncompressed WebDataset-style tar shards.
+
+    Each sample is a group of tar members sharing a key, e.g. `000123.jpg`
+    and `000123.cls`, where the `.cls` member contains the class index as
+    text.  Items are `(PIL.Image, target)` pairs, like torchvision's image
+    datasets, so they can be wrapped in a :class:`Pipeline`.
+
+    The shards are indexed once when the dataset is created.  Afterwards,
+    consecutive samples are read from large blocks, so a sequential pass
+    costs one bulk read per block instead of one file open per image.  Blocks
+    only extend through the samples that will be read next, so sparse access
+    reads just the requested images.
+    """
+    def __init__(self, paths, *, blocksize=8 * 1024 * 1024, classes=None, extensions=("jpeg", "jpg", "png", "webp"), target_transform=None, transform=None):
+        self.paths = list(paths)
+        self.blocksize = blocksize
+        self.transform = transform
+        self.target_transform = target_transform
+        self.samples = []
+        self.targets = []
+
+        for shard, path in enumerate(self.paths):
+            # Buffered reads let the tarfile module skip over image data without a request per member.
+            with open(path, "rb", buffering=blocksize) as stream, tarfile.open(fileobj=stream, mode="r:") as archive:
+                images = {}
+                labels = {}
+                for member in archive:
+                    if not member.isfile():
+                        continue
+                    dirname, basename = posixpath.split(member.name)
+                    key, _, extension = basename.partition(".")
+                    key = posixpath.join(dirname, key)
+                    if extension.lower() in extensions:
+                        images[key] = (shard, member.offset_data, member.size)
+                    elif extension == "cls":
+                        labels[key] = int(archive.extractfile(member).read())
+            for key, sample in images.items():
+                if key not in labels:
+                    raise ValueError(f"Sample {key} in {path} has no class label.")
+                self.samples.append(sample)
+                self.targets.append(labels[key])
+
+        self.classes = list(classes) if classes is not None else [str(index) for index in range(max(self.targets, default=-1) + 1)]
+        self._pid = None
+        self._successors = None
+
+    def __getstate__(self):
+        # Open files, cached blocks, and the last sample read are per-process.
+        state = dict(self.__dict__)
+        state.update(_block=None, _last=None, _lock=None, _pid=None, _stream=None)
+        return state
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        image = PIL.Image.open(io.BytesIO(self._read(index))).convert("RGB")
+        target = self.targets[index]
+        if self.transform is not None:
+            image = self.transform(image)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return image, target
+
+    def _plan(self, indices):
+        # Samples will only be read in this order, e.g. after subsampling, so read-ahead skips the others.
+        self._successors = dict(zip(indices, indices[1:]))
+
+    def _read(self, index):
+        # Forked data loader workers can't share open files, so state is reset in each process.
+        if self._pid != os.getpid():
+            self._block, self._last, self._lock, self._pid, self._stream = None, None, threading.Lock(), os.getpid(), None
+
+        shard, offset, size = self.samples[index]
+        with self._lock:
+            # Only read ahead once samples are being read in order.
+            sequential = self._last is not None and self._successor(self._last) == index
+            self._last = index
+
+            if self._block is not None:
+                blockshard, blockoffset, data = self._block
+                if blockshard == shard and blockoffset <= offset and offset + size <= blockoffset + len(data):
+                    return data[offset - blockoffset:offset - blockoffset + size]
+
+            # End the block at the last of the following samples that fit, or read just this sample when the next one
+            # is too far away.
+            end = offset + size
+            following = self._successor(index) if sequential else None
+            while following is not None:
+                nextshard, nextoffset, nextsize = self.samples[following]
+                if nextshard != shard or nextoffset < end or nextoffset + nextsize - offset > self.blocksize:
+                    break
+                end = nextoffset + nextsize
+                following = self._successor(following)
+
+            # Keep a single shard open, since datasets may have thousands of them.
+            if self._stream is None or self._stream[0] != shard:
+                if self._stream is not None:
+                    self._stream[1].close()
+                self._stream = (shard, open(self.paths[shard], "rb", buffering=0))
+            stream = self._stream[1]
+            stream.seek(offset)
+            data = stream.read(end - offset)
+            self._block = (shard, offset, data)
+            return data[:size]
+
+    def _successor(self, index):
+        if self._successors is not None:
+            return self._successors.get(index)
+        return index + 1 if index + 1 < len(self.samples) else None
+
+
+def _activationkey(modelhash, dataset, mode):
+    # The key covers the cache format, model weights, evaluation mode, and dataset.
+    hash = modelhash.copy()
+    hash.update(_cacheversion.encode())
+    hash.update(mode.encode())
+    hash.update(_datasetkey(dataset).encode())
+    return hash.hexdigest()
+
+
+def _accumulatetopk(activations, values, examples, *, locations=None, maps=None):
+    # Merge the batch into each channel's running top-k samples, along with their optional spatial data.
+    samples = torch.arange(activations.count, activations.count + len(values)).unsqueeze(1).expand_as(values)
+    if activations.channelvalues is not None:
+        values, samples = torch.cat((activations.channelvalues, values)), torch.cat((activations.channelsamples, samples))
+        if maps is not None:
+            locations, maps = torch.cat((activations.channellocations, locations)), torch.cat((activations.channelmaps, maps))
+    activations.channelvalues, order = _mergetopk(values, examples)
+    activations.channelsamples = torch.gather(samples, 0, order)
+    if maps is not None:
+        activations.channellocations = torch.gather(locations, 0, order)
+        activations.channelmaps = _gathermaps(maps, order)
+
+
+def _bytecodecache():
+    directory = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "samlab", "jinja2")
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        return None
+    return jinja2.FileSystemBytecodeCache(directory)
+
+
+def _checkslugs(datasets):
+    # Slugs name each dataset's output directory and its entries in the manifest, so they must be unique.
+    names = {}
+    for dataset in datasets:
+        if dataset.slug in names:
+            raise ValueError(f"Datasets {names[dataset.slug]} and {dataset.name} have the same slug {dataset.slug}, so their pages would overwrite each other.  Give them different names.")
+        names[dataset.slug] = dataset.name
+
+
+def _channelstatistics(activations, channel):
+    # Summarize one channel's running statistics, with quantiles estimated from its sketch, and a histogram of at most 32 bars.
+    # Indexing numpy arrays is much faster than indexing tensors one element at a time.
+    count = int(activations.statscount.numpy()[channel])
+    histogram = activations.statshistogram.numpy()[channel]
+    minimum, maximum = float(activations.statsmin.numpy()[channel]), float(activations.statsmax.numpy()[channel])
+    zeros = int(activations.statszeros.numpy()[channel])
+    if not count:
+        return dict(bars=[], count=0, dead=False, maximum=None, mean=None, minimum=None, quantiles=[], std=None, zeros=None)
+
+    lowers, uppers, values = _sketchtable()
+    bins = numpy.searchsorted(numpy.cumsum(histogram), numpy.array(_quantiles) * count, side="left")
+    quantiles = [Namespace(quantile=quantile, value=value) for quantile, value in zip(_quantiles, numpy.clip(values[bins], minimum, maximum).tolist())]
+
+    nonempty = numpy.flatnonzero(histogram)
+    first, last = nonempty[0], nonempty[-1] + 1
+    width = math.ceil((last - first) / 32)
+    begins = numpy.arange(first, last, width)
+    counts = numpy.add.reduceat(histogram[first:last], begins - first)
+    bars = [Namespace(count=count, height=height, lower=lower, upper=upper) for count, height, lower, upper in zip(
+        counts.tolist(),
+        (100 * counts / counts.max()).tolist(),
+        numpy.maximum(lowers[begins], minimum).tolist(),
+        numpy.minimum(uppers[numpy.minimum(begins + width, last) - 1], maximum).tolist(),
+        )]
+
+    return dict(
+        bars=bars,
+        count=count,
+        dead=zeros == count,
+        maximum=maximum,
+        mean=float(activations.statsmean.numpy()[channel]),
+        minimum=minimum,
+        quantiles=quantiles,
+        std=math.sqrt(float(activations.statsm2.numpy()[channel]) / count),
+        zeros=zeros / count,
+        )
+
+
+def _correlations(activations, *, pairs=20, partners=5):
+    # Convert a layer's co-moments into correlations, keeping each channel's strongest partners, the layer's strongest
+    # pairs, and an ordering that places correlated channels next to each other.
+    deviations = torch.sqrt(torch.diagonal(activations.corrcomoment))
+    correlation = torch.nan_to_num(activations.corrcomoment / torch.outer(deviations, deviations), nan=0.0, posinf=0.0, neginf=0.0).float()
+    channels = len(correlation)
+    correlation.fill_diagonal_(-math.inf)
+
+    activations.corrpartnervalues, activations.corrpartners = torch.topk(correlation, min(partners, channels - 1), dim=1)
+    upper = torch.triu(torch.ones((channels, channels), dtype=torch.bool), diagonal=1)
+    activations.corrpairvalues, indices = torch.topk(correlation.masked_fill(~upper, -math.inf).flatten(), min(pairs, channels * (channels - 1) // 2))
+    activations.corrpairs = torch.stack((indices // channels, indices % channels), dim=1)
+
+    # Chain each channel to its most correlated unvisited channel, starting from the most correlated channel overall.
+    similarity = correlation.numpy()
+    visited = numpy.zeros(channels, dtype=bool)
+    current = int(numpy.argmax(numpy.where(numpy.isinf(similarity), 0, similarity).sum(axis=1))) if channels else 0
+    order = []
+    for index in range(channels):
+        order.append(current)
+        visited[current] = True
+        if index + 1 < channels:
+            current = int(numpy.argmax(numpy.where(visited, -numpy.inf, similarity[current])))
+    activations.corrorder = torch.tensor(order, dtype=torch.int64)
+
+
+def _covariance(values):
+    # Co-moments of a batch of values, in the form kept by _mergecovariance().
+    values = values.double()
+    mean = values.mean(dim=0)
+    centered = values - mean
+    return Namespace(
+        corrcount=torch.tensor([len(values)], dtype=torch.int64),
+        corrmean=mean,
+        corrcomoment=centered.T @ centered,
+        )
+
+
+def _current(targetdir, entry, digest):
+    # A file is current if its content hasn't changed and it hasn't been modified since it was written.
+    if entry is None or entry["digest"] != digest:
+        return False
+    try:
+        stat = os.stat(os.path.join(targetdir, entry["path"]))
+    except FileNotFoundError:
+        return False
+    return stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime"]
+
+
+def _datasetkey(dataset):
+    # The key covers the dataset identity, subset indices, and preprocessing.
+    hash = hashlib.sha256()
+    hash.update(dataset.slug.encode())
+
+    source = dataset.evaluate
+    while isinstance(source, (torch.utils.data.Subset, Pipeline)):
+        if isinstance(source, Pipeline):
+            hash.update(repr(source).encode())
+        else:
+            hash.update(torch.as_tensor(source.indices, dtype=torch.int64).numpy().tobytes())
+        source = source.dataset
+
+    hash.update(type(source).__qualname__.encode())
+    hash.update(str(len(source)).encode())
+    hash.update(str(getattr(source, "root", "")).encode())
+    hash.update(str(getattr(source, "paths", "")).encode())
+    for transform in [getattr(source, "transform", None), getattr(source, "target_transform", None)]:
+        # Strip memory addresses so that lambdas and other functions hash consistently.
+        hash.update(re.sub(r" at 0x[0-9a-fA-F]+", "", repr(transform)).encode())
+
+    return hash.hexdigest()
+
+
+def _decodeimage(dataset, index):
+    # Return a single cropped uint8 image, using the view dataset if there isn't a pipeline.
+    if isinstance(_unwrap(dataset.evaluate), Pipeline):
+        x, image, y = dataset.evaluate[index]
+        return image
+    x, y = dataset.view[index]
+    return torchvision.transforms.v2.functional.to_image(x[0])
+
+
+def _decodeimages(dataset, imagecallback, *, batchsize, device, prefetch, workers):
+    counter = enlighten.get_manager().counter(total=len(dataset.evaluate), desc="Images", unit="samples", leave=False)
+
+    # Decode images without evaluating the model, using the view dataset if there isn't a pipeline.
+    if isinstance(_unwrap(dataset.evaluate), Pipeline):
+        offset = 0
+        for x, images, y in _loader(dataset, batchsize=batchsize, device=device, prefetch=prefetch, workers=workers):
+            imagecallback(dataset, offset, images)
+            offset += len(images)
+            counter.update(len(images))
+    else:
+        for index in range(len(dataset.view)):
+            imagecallback(dataset, index, _decodeimage(dataset, index).unsqueeze(0))
+            counter.update()
+    counter.close()
+
+
+def _encodeimage(image, format, **kwargs):
+    stream = io.BytesIO()
+    image.save(stream, format=format, **kwargs)
+    return stream.getvalue()
+
+
+@functools.cache
+def _environment():
+    # Templates never change during a run, and their compiled bytecode is cached across runs, keyed by their source.
+    return jinja2.Environment(
+        loader=jinja2.PackageLoader("samlab.deepvis"),
+        autoescape=jinja2.select_autoescape(),
+        auto_reload=False,
+        bytecode_cache=_bytecodecache(),
+        )
+
+
+def _evaluate(dataset, model, *, batchsize, channelslast, device, imagecallback, precision, prefetch, tracer=None, workers):
+    if precision not in ["fp32", "bf16"]:
+        raise ValueError(f"Unsupported precision: {precision}")
+
+    counter = enlighten.get_manager().counter(total=math.ceil(len(dataset.evaluate) / batchsize), desc="Evaluate", unit="batches", leave=False)
+    loader = _loader(dataset, batchsize=batchsize, device=device, prefetch=prefetch, workers=workers)
+    memoryformat = torch.channels_last if channelslast else torch.contiguous_format
+
+    # Autograd state is never needed, and eval mode keeps dropout and batch normalization deterministic.
+    model.eval()
+    start = time.perf_counter()
+    offset = 0
+    with torch.inference_mode(), torch.autocast(device.type, dtype=torch.bfloat16, enabled=precision == "bf16"):
+        for batch in loader:
+            x = (item.to(device, memory_format=memoryformat) if item.ndim == 4 else item.to(device) for item in batch[0])
+            try:
+                model(*x)
+            except _EarlyExit:
+                pass
+
+            # Pipelines return the decoded images along with the model inputs.
+            if len(batch) == 3 and imagecallback is not None:
+                imagecallback(dataset, offset, batch[1])
+            offset += len(batch[1])
+            counter.update()
+            if tracer is not None:
+                tracer.step()
+    elapsed = time.perf_counter() - start
+    counter.close()
+
+    log.info(f"Evaluated {len(dataset.evaluate)} samples in {elapsed:.1f}s ({len(dataset.evaluate) / elapsed:.1f} samples/s)")
+
+
+def _fileentry(targetdir, path, *, digest=None):
+    # Manifest entry for a file that's already been written.
+    filepath = os.path.join(targetdir, path)
+    if digest is None:
+        with open(filepath, "rb") as stream:
+            digest = hashlib.sha256(stream.read()).hexdigest()
+    stat = os.stat(filepath)
+    return {"path": path, "digest": digest, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def _gathermaps(maps, order):
+    return torch.gather(maps, 0, order[:, :, None, None].expand(-1, -1, *maps.shape[2:]))
+
+
+def _layerpage(slices, layer):
+    # Channels are listed in clustered order when correlations are available for the first dataset.
+    clustered = layer.channels.correlations[0] if layer.channels.correlations else None
+    order = clustered[1].corrorder.tolist() if clustered is not None else range(len(layer.channels))
+    return Namespace(**vars(slices.layers[layer.index]), channels=[slices.previews[(layer.index, channel)] for channel in order], clustered=slices.datasets[clustered[0].slug] if clustered is not None else None, correlations=[Namespace(
+        dataset=slices.datasets[dataset.slug],
+        pairs=[Namespace(
+            first=slices.previews[(layer.index, first)],
+            second=slices.previews[(layer.index, second)],
+            value=value,
+            ) for (first, second), value in zip(activations.corrpairs.tolist(), activations.corrpairvalues.tolist())],
+        ) for dataset, activations in layer.channels.correlations], statistics=[Namespace(
+        dataset=slices.datasets[dataset.slug],
+        dead=[slices.previews[(layer.index, channel)] for channel in torch.nonzero((activations.statszeros == activations.statscount) & (activations.statscount > 0)).flatten().tolist()],
+        mean=float(activations.statsmean.mean()),
+        std=float(torch.sqrt(activations.statsm2 / activations.statscount.clamp(min=1)).mean()),
+        zeros=float((activations.statszeros / activations.statscount.clamp(min=1)).mean()),
+        ) for dataset, activations in layer.channels.statistics])
+
+
+def _loadactivations(cachedir, key, layers):
+    entrydir = os.path.join(cachedir, key)
+    if not os.path.exists(os.path.join(entrydir, "index.json")):
+        return None
+
+    with open(os.path.join(entrydir, "index.json"), "r") as stream:
+        index = json.load(stream)
+    if sorted(index["layers"]) != sorted(layer.name for layer in layers):
+        return None
+
+    # Copy-on-write mappings let torch wrap the arrays without reading them into memory.
+    activations = {}
+    for name, entry in index["layers"].items():
+        activations[name] = Namespace(nchannels=entry["nchannels"], arrays={})
+        for field in entry["arrays"]:
+            activations[name].arrays[field] = torch.from_numpy(numpy.load(os.path.join(entrydir, name, f"{field}.npy"), mmap_mode="c"))
+    return activations
+
+
+def _loader(dataset, *, batchsize, device, prefetch, workers):
+    return torch.utils.data.DataLoader(
+        dataset.evaluate,
+        batch_size=batchsize,
+        num_workers=workers,
+        pin_memory=device.type == "cuda",
+        prefetch_factor=prefetch if workers else None,
+        shuffle=False,
+        )
+
+
+def _loadmanifest(targetdir):
+    manifest = {}
+    path = os.path.join(targetdir, "manifest.jsonl")
+    if os.path.exists(path):
+        with open(path, "r") as stream:
+            for line in stream:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Interrupted runs may leave a truncated final line.
+                    continue
+                manifest[entry["path"]] = entry
+    return manifest
+
+
+def _mergecovariance(activations, covariance):
+    # Combine running co-moments with Chan's algorithm, so batches and shards can be accumulated in any grouping.
+    if activations.corrcount is None:
+        for field in _covariancefields:
+            setattr(activations, field, covariance[field])
+        return
+    count = activations.corrcount + covariance.corrcount
+    delta = covariance.corrmean - activations.corrmean
+    weight = float(covariance.corrcount) / float(count)
+    # Update in-place, since the accumulators may be large.
+    activations.corrcomoment += covariance.corrcomoment
+    activations.corrcomoment.addr_(delta, delta, alpha=float(activations.corrcount) * weight)
+    activations.corrmean = activations.corrmean + delta * weight
+    activations.corrcount = count
+
+
+def _mergestatistics(activations, statistics):
+    # Combine running per-channel statistics, updating the mean and sum of squared deviations with Chan's algorithm.
+    if activations.statscount is None:
+        for field in _statisticsfields:
+            setattr(activations, field, statistics[field])
+        return
+    count = activations.statscount + statistics.statscount
+    delta = statistics.statsmean - activations.statsmean
+    weight = statistics.statscount.double() / count.clamp(min=1).double()
+    activations.statsm2 = activations.statsm2 + statistics.statsm2 + delta ** 2 * activations.statscount.double() * weight
+    activations.statsmean = activations.statsmean + delta * weight
+    activations.statscount = count
+    activations.statszeros = activations.statszeros + statistics.statszeros
+    activations.statsmin = torch.minimum(activations.statsmin, statistics.statsmin)
+    activations.statsmax = torch.maximum(activations.statsmax, statistics.statsmax)
+    activations.statshistogram = activations.statshistogram + statistics.statshistogram
+
+
+def _mergetopk(values, examples):
+    # Candidates are ordered by sample, so a stable sort breaks ties by sample index, independent of how the samples were batched or sharded.
+    values, order = torch.sort(values, dim=0, descending=True, stable=True)
+    return values[:examples], order[:examples]
+
+
+def _modelhash(model):
+    hash = hashlib.sha256()
+    hash.update(repr(model).encode())
+    for name, tensor in model.state_dict().items():
+        tensor = tensor.detach().cpu().contiguous().reshape(-1)
+        hash.update(name.encode())
+        hash.update(str(tensor.dtype).encode())
+        hash.update(tensor.view(torch.uint8).numpy().tobytes())
+    return hash
+
+
+def _nearestneighbors(vectors, count, *, budget=16 * 1024 * 1024):
+    # Rank samples by the cosine similarity of their centered vectors, comparing blocks of samples against every
+    # sample so the full similarity matrix is never formed, and excluding each sample from its own neighbors.
+    vectors = vectors.float()
+    vectors = torch.nn.functional.normalize(vectors - vectors.mean(dim=0), dim=1)
+    count = min(count, len(vectors) - 1)
+    samples = torch.empty((len(vectors), max(0, count)), dtype=torch.int64)
+    values = torch.empty((len(vectors), max(0, count)), dtype=torch.float32)
+    if count < 1:
+        return samples, values
+
+    blocksize = max(1, budget // len(vectors))
+    for begin in range(0, len(vectors), blocksize):
+        end = min(begin + blocksize, len(vectors))
+        similarity = vectors[begin:end] @ vectors.T
+        similarity[torch.arange(end - begin), torch.arange(begin, end)] = -math.inf
+        values[begin:end], samples[begin:end] = torch.topk(similarity, count, dim=1)
+    return samples, values
+
+
+def _peakrss():
+    # The resource module is only available on Unix, and reports kilobytes everywhere but macOS.
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+@contextlib.contextmanager
+def _phase(profile, name):
+    # Accumulate wall time and resident memory growth for a phase, excluding nested phases, e.g. writing images during
+    # the forward pass.
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    rss = _rss()
+    _phasestack.append([name, 0.0, 0])
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        growth = None if rss is None else _rss() - rss
+        stats = _profilephase(profile, name)
+        nested = _phasestack.pop()
+        stats["seconds"] += elapsed - nested[1]
+        if growth is not None:
+            stats["rssgrowth"] = (stats["rssgrowth"] or 0) + growth - nested[2]
+        if _phasestack:
+            _phasestack[-1][1] += elapsed
+            if growth is not None:
+                _phasestack[-1][2] += growth
+
+
+def _profilecount(profile, *, phase=None, **counts):
+    # Add counts to a phase, defaulting to the innermost running phase.
+    if profile is None:
+        return
+    stats = _profilephase(profile, phase)
+    for key, value in counts.items():
+        stats[key] += value
+
+
+def _profilephase(profile, name=None):
+    name = _phasestack[-1][0] if name is None else name
+    return profile.setdefault("phases", {}).setdefault(name, {"bytes": 0, "files": 0, "rssgrowth": None, "samples": 0, "seconds": 0.0, "unchanged": 0})
+
+
+def _profilereport(profile, *, elapsed, options):
+    # Add derived statistics and the environment to a profile, so it can be compared across runs.
+    for stats in profile.get("phases", {}).values():
+        stats["samplespersecond"] = stats["samples"] / stats["seconds"] if stats["samples"] and stats["seconds"] else None
+    profile["environment"] = {
+        "cpus": os.cpu_count(),
+        "platform": sys.platform,
+        "python": sys.version.split()[0],
+        "torch": torch.__version__,
+        "torchvision": torchvision.__version__,
+        }
+    profile["options"] = options
+    profile["total"] = {
+        "bytes": sum(stats["bytes"] for stats in profile.get("phases", {}).values()),
+        "files": sum(stats["files"] for stats in profile.get("phases", {}).values()),
+        "peakrss": _peakrss(),
+        "seconds": elapsed,
+        }
+    return profile
+
+
+def _receptivebox(field, location):
+    # Shift the center unit's receptive field to another unit, clipped to the image, as (left, top, right, bottom).
+    y, x = divmod(location, field.size[1])
+    dy, dx = round((y - field.center[0]) * field.stride[0]), round((x - field.center[1]) * field.stride[1])
+    top, left, bottom, right = field.box
+    return (max(0, left + dx), max(0, top + dy), min(field.inputsize[1], right + dx), min(field.inputsize[0], bottom + dy))
+
+
+def _receptivefields(model, layers, inputs, *, count=4):
+    # Measure receptive fields from the input gradients of each layer's center unit, which unlike accumulating
+    # kernel sizes and strides also works for branching architectures.  Several random inputs reduce the
+    # chance that max pooling or dead units hide part of the field.
+    outputs = {}
+
+    def capture_fn(layer, module, inputs, output):
+        if output.ndim == 4:
+            outputs[layer.index] = output.clone()
+
+    handles = [layer.module.register_forward_hook(functools.partial(capture_fn, layer)) for layer in layers]
+    try:
+        model.eval()
+        with torch.enable_grad():
+            x = torch.randn(count, *inputs[0].shape, device=next(model.parameters()).device, requires_grad=True)
+            model(x, *[item.unsqueeze(0).expand(count, *item.shape).to(x.device) for item in inputs[1:]])
+
+            fields = {}
+            for index, output in outputs.items():
+                size = tuple(output.shape[2:])
+                center = (size[0] // 2, size[1] // 2)
+                gradient, = torch.autograd.grad(output[:, :, center[0], center[1]].sum(), x, retain_graph=True)
+                rows = torch.nonzero(gradient.abs().sum(dim=(0, 1)).sum(dim=1)).flatten().tolist()
+                columns = torch.nonzero(gradient.abs().sum(dim=(0, 1)).sum(dim=0)).flatten().tolist()
+                box = (rows[0], columns[0], rows[-1] + 1, columns[-1] + 1) if rows else (0, 0, x.shape[2], x.shape[3])
+                fields[index] = Namespace(box=box, center=center, inputsize=tuple(x.shape[2:]), size=size, stride=(x.shape[2] / size[0], x.shape[3] / size[1]))
+    finally:
+        for handle in handles:
+            handle.remove()
+    return fields
+
+
+def _renderpages(targetdir, template, pages):
+    # Render a batch of pages that share a template, each with its own context, streaming them to disk.
+    template = _template(template)
+    entries = []
+    for path, context, entry in pages:
+        path = "/".join([path, "index.html"]) if path else "index.html"
+        stream = template.stream(context)
+        stream.enable_buffering(64)
+        entries.append(_writestream(targetdir, path, stream, entry))
+    return entries
+
+
+def _rss():
+    # The current resident set size of this process, which is only available on Linux.
+    try:
+        with open("/proc/self/statm", "r") as stream:
+            return int(stream.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _samplefiles(dataset):
+    # Find the size and modification time of the file each sample is read from, so replaced images can be detected
+    # without decoding them.  Sources that don't expose their files are identified by index alone.
+    indices = list(range(len(dataset.evaluate)))
+    source = dataset.evaluate
+    while isinstance(source, (torch.utils.data.Subset, Pipeline)):
+        if isinstance(source, torch.utils.data.Subset):
+            indices = [int(source.indices[index]) for index in indices]
+        source = source.dataset
+
+    if isinstance(source, TarShards):
+        paths = [source.paths[shard] for shard, offset, size in source.samples]
+    elif isinstance(source, torchvision.datasets.Caltech101):
+        paths = [os.path.join(source.root, "101_ObjectCategories", source.categories[target], f"image_{index:04d}.jpg") for target, index in zip(source.y, source.index)]
+    elif isinstance(getattr(source, "samples", getattr(source, "imgs", None)), list):
+        paths = [sample[0] for sample in getattr(source, "samples", getattr(source, "imgs", None))]
+    else:
+        return numpy.zeros((len(indices), 2), dtype=numpy.int64)
+
+    stats = {}
+    files = numpy.zeros((len(indices), 2), dtype=numpy.int64)
+    for row, index in enumerate(indices):
+        path = paths[index]
+        if path not in stats:
+            try:
+                stat = os.stat(path)
+                stats[path] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                stats[path] = (0, 0)
+        files[row] = stats[path]
+    return files
+
+
+def _samplepage(slices, dataset, sample):
+    return Namespace(**sample, activations=[Namespace(
+        channels=[slices.previews[(activations.layer.index, channel.index)] for channel in activations.channels],
+        layer=slices.layers[activations.layer.index],
+        values=activations.values,
+        ) for activations in sample.activations], neighbors=[Namespace(
+        layer=slices.layers[neighbors.layer.index],
+        samples=[Namespace(**neighbor) for neighbor in neighbors.samples],
+        values=neighbors.values,
+        ) for neighbors in sample.neighbors])
+
+
+def _saveactivations(cachedir, key, layers, fields, *, shard=None):
+    entrydir = os.path.join(cachedir, key)
+    tempdir = f"{entrydir}.{os.getpid()}"
+
+    # Write to a temporary directory and rename it, so interrupted runs never leave a partial entry.
+    index = {"layers": {}}
+    if shard is not None:
+        index["shard"] = shard
+    for layer in layers:
+        os.makedirs(os.path.join(tempdir, layer.name), exist_ok=True)
+        # Spatial data only exists for layers with spatial outputs.
+        arrays = [field for field in fields if field in layer.activations[-1].keys() and layer.activations[-1][field] is not None]
+        for field in arrays:
+            numpy.save(os.path.join(tempdir, layer.name, f"{field}.npy"), layer.activations[-1][field].numpy())
+        index["layers"][layer.name] = {"nchannels": layer.nchannels, "arrays": arrays}
+    with open(os.path.join(tempdir, "index.json"), "w") as stream:
+        json.dump(index, stream)
+
+    if os.path.exists(entrydir):
+        shutil.rmtree(entrydir)
+    os.rename(tempdir, entrydir)
+
+
+def _savefile(targetdir, path, encode, entry, *, digest, store=None):
+    # Optionally encode content once into a store shared between sites, named by a hash of the source that determines
+    # its content, and hard link it into the target directory.
+    if store is None:
+        return _writefile(targetdir, path, encode(), entry, digest=digest)
+    if _current(targetdir, entry, digest):
+        return entry
+
+    name = hashlib.sha256(digest.encode()).hexdigest()
+    storepath = os.path.join(store, name[:2], f"{name}{posixpath.splitext(path)[1]}")
+    if not os.path.exists(storepath):
+        os.makedirs(os.path.dirname(storepath), exist_ok=True)
+        temppath = f"{storepath}.{os.getpid()}"
+        with open(temppath, "wb") as stream:
+            stream.write(encode())
+        os.replace(temppath, storepath)
+
+    filepath = os.path.join(targetdir, path)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    temppath = f"{filepath}.{os.getpid()}"
+    if os.path.exists(temppath):
+        os.remove(temppath)
+    try:
+        os.link(storepath, temppath)
+    except OSError:
+        # Copy instead across filesystems, or where hard links aren't supported.
+        shutil.copyfile(storepath, temppath)
+    os.replace(temppath, filepath)
+    return _fileentry(targetdir, path, digest=digest)
+
+
+def _saveimages(targetdir, slug, offset, images, sources, entries, thumbnails, store=None):
+    # Images are keyed by their source, so current images are skipped without encoding them.
+    written = []
+    for index, image, source, (imageentry, thumbnailentry) in zip(itertools.count(offset), images, sources, entries):
+        sampledir = f"datasets/{slug}/samples/{index}"
+        thumbnailsource = _thumbnailsource(source, thumbnails)
+        if _current(targetdir, imageentry, source) and _current(targetdir, thumbnailentry, thumbnailsource):
+            written += [imageentry, thumbnailentry]
+            continue
+
+        image = PIL.Image.fromarray(numpy.ascontiguousarray(image.transpose(1, 2, 0)))
+        written.append(_savefile(targetdir, f"{sampledir}/image.png", functools.partial(_encodeimage, image, "png"), imageentry, digest=source, store=store))
+
+        image.thumbnail((thumbnails.size, thumbnails.size))
+        written.append(_savefile(targetdir, f"{sampledir}/thumbnail.{thumbnails.extension}", functools.partial(_encodeimage, image, thumbnails.format, quality=thumbnails.quality), thumbnailentry, digest=thumbnailsource, store=store))
+    return written
+
+
+def _savespatial(targetdir, strips, thumbnails):
+    # Combine receptive field crops, and heatmaps overlaid on the images, for a strip of samples.  Top samples
+    # recur across channels, so each image is decoded once per batch of strips.
+    images = {}
+    written = []
+    for croppath, overlaypath, paths, boxes, maps, columns, source, cropentry, overlayentry in strips:
+        if _current(targetdir, cropentry, f"{source}:crops") and _current(targetdir, overlayentry, f"{source}:overlays"):
+            written += [cropentry, overlayentry]
+            continue
+
+        rows = math.ceil(len(paths) / columns)
+        crops = PIL.Image.new("RGB", (thumbnails.size * columns, thumbnails.size * rows))
+        overlays = PIL.Image.new("RGB", (thumbnails.size * columns, thumbnails.size * rows))
+        for index, (path, box, heatmap) in enumerate(zip(paths, boxes, maps)):
+            position = ((index % columns) * thumbnails.size, (index // columns) * thumbnails.size)
+            if path not in images:
+                with PIL.Image.open(os.path.join(targetdir, path)) as image:
+                    image = image.convert("RGB")
+                thumbnail = image.copy()
+                thumbnail.thumbnail((thumbnails.size, thumbnails.size))
+                images[path] = (image, thumbnail)
+            image, thumbnail = images[path]
+            crops.paste(PIL.ImageOps.pad(image.crop(box), (thumbnails.size, thumbnails.size)), position)
+
+            heatmap = heatmap - heatmap.min()
+            heatmap = heatmap / heatmap.max() if heatmap.max() > 0 else heatmap
+            mask = PIL.Image.fromarray((heatmap * 160).astype(numpy.uint8)).resize(thumbnail.size, PIL.Image.BILINEAR)
+            overlays.paste(PIL.Image.composite(PIL.Image.new("RGB", thumbnail.size, (255, 0, 0)), thumbnail, mask), position)
+        written.append(_writefile(targetdir, croppath, _encodeimage(crops, thumbnails.format, quality=thumbnails.quality), cropentry, digest=f"{source}:crops"))
+        written.append(_writefile(targetdir, overlaypath, _encodeimage(overlays, thumbnails.format, quality=thumbnails.quality), overlayentry, digest=f"{source}:overlays"))
+    return written
+
+
+def _savesprites(targetdir, sprites, thumbnails):
+    # Combine the thumbnails for a strip of samples into a single image.
+    written = []
+    for path, paths, columns, source, entry in sprites:
+        if _current(targetdir, entry, source):
+            written.append(entry)
+            continue
+
+        rows = math.ceil(len(paths) / columns)
+        sprite = PIL.Image.new("RGB", (thumbnails.size * columns, thumbnails.size * rows))
+        for index, tilepath in enumerate(paths):
+            with PIL.Image.open(os.path.join(targetdir, tilepath)) as tile:
+                sprite.paste(tile, ((index % columns) * thumbnails.size, (index // columns) * thumbnails.size))
+        written.append(_writefile(targetdir, path, _encodeimage(sprite, thumbnails.format, quality=thumbnails.quality), entry, digest=source))
+    return written
+
+
+def _selected(name, patterns):
+    # Patterns are shell-style wildcards, and a leading "!" excludes matching layers.
+    if patterns is None:
+        return True
+    includes = [pattern for pattern in patterns if not pattern.startswith("!")]
+    excludes = [pattern[1:] for pattern in patterns if pattern.startswith("!")]
+    if includes and not any(fnmatch.fnmatchcase(name, pattern) for pattern in includes):
+        return False
+    return not any(fnmatch.fnmatchcase(name, pattern) for pattern in excludes)
+
+
+def _shardkey(key, shard):
+    return f"{key}.shard-{shard[0]}-of-{shard[1]}"
+
+
+def _shards(context, thumbnails, *, blocksize=64):
+    # Write the context as compact little-endian shards for the client-side viewer.
+    layers = context.model.layers
+    index = Namespace(
+        blocksize=blocksize,
+        datasets=[],
+        layers=[],
+        thumbnail=thumbnails.extension,
+        title=context.title,
         )
 
-    dictionary = [item for item in evaluate.categories]
+    # Previews contain the top three samples for every channel in the first dataset.
+    previews = []
+    for layer in layers:
+        index.layers.append(dict(
+            channels=[channel.name for channel in layer.channels] if layer.name in context.channelnames else None,
+            conv=layer.conv,
+            index=layer.index,
+            name=layer.name,
+            nchannels=layer.nchannels,
+            previewoffset=sum(len(preview) for preview in previews),
+            type=layer.type,
+            ))
+        preview = torch.full((layer.nchannels, 3), -1, dtype=torch.int32)
+        if layer.activations and layer.nchannels:
+            samples = layer.activations[0].channelsamples[:3].T
+            preview[:, :samples.shape[1]] = samples
+        previews.append(preview.flatten())
+    yield "data/previews.bin", _shardbytes(torch.cat(previews))
+
+    for datasetindex, dataset in enumerate(context.datasets):
+        index.datasets.append(dict(
+            categories={category.index: category.name for category in dataset.categories},
+            count=len(dataset.samples),
+            examples=len(layers[0].activations[datasetindex].channelsamples) if layers else 0,
+            name=dataset.name,
+            slug=dataset.slug,
+            ))
+        yield f"data/datasets/{dataset.slug}/targets.bin", _shardbytes(torch.from_numpy(dataset.samples.categories).int())
+
+        # Layer shards contain every channel's top samples and values, in channel-major order.
+        for layer in layers:
+            activations = layer.activations[datasetindex]
+            yield f"data/layers/{layer.index}/{dataset.slug}.bin", _shardbytes(activations.channelsamples.T, activations.channelvalues.T)
+
+        # Sample shards contain the top ten channels and values for every layer, in blocks of samples.
+        for begin in range(0, len(dataset.samples), blocksize):
+            end = min(begin + blocksize, len(dataset.samples))
+            channels = torch.full((end - begin, len(layers), 10), -1, dtype=torch.int32)
+            values = torch.zeros((end - begin, len(layers), 10), dtype=torch.float32)
+            for layerindex, layer in enumerate(layers):
+                activations = layer.activations[datasetindex]
+                count = activations.samplechannels.shape[1]
+                channels[:, layerindex, :count] = activations.samplechannels[begin:end]
+                values[:, layerindex, :count] = activations.samplevalues[begin:end]
+            yield f"data/datasets/{dataset.slug}/samples/{begin // blocksize}.bin", _shardbytes(channels, values)
+
+    yield "data/index.json", json.dumps(vars(index)).encode()
+
+
+def _shardbytes(*arrays):
+    # Indices are stored as int32 and values as float32, so the viewer can use typed array views.
+    return b"".join(array.contiguous().numpy().astype("<i4" if not array.is_floating_point() else "<f4").tobytes() for array in arrays)
+
+
+def _sketchbins(values):
+    # Map values to fixed logarithmic buckets, ordered by value with zero in the middle, so sketches merge by addition.
+    magnitudes = (torch.ceil(torch.log10(values.abs()) * _sketchresolution).clamp(-_sketchdecades * _sketchresolution, _sketchdecades * _sketchresolution) + _sketchdecades * _sketchresolution).long()
+    return torch.where(values > 0, _sketchmagnitudes + 1 + magnitudes, torch.where(values < 0, _sketchmagnitudes - 1 - magnitudes, _sketchmagnitudes))
+
+
+def _sketchbounds(bin):
+    # The range of values in a bucket, where the smallest and largest magnitudes also collect values beyond them.
+    if bin == _sketchmagnitudes:
+        return (0.0, 0.0)
+    exponent = (abs(bin - _sketchmagnitudes) - 1) / _sketchresolution - _sketchdecades
+    lower, upper = 10 ** (exponent - 1 / _sketchresolution), 10 ** exponent
+    return (lower, upper) if bin > _sketchmagnitudes else (-upper, -lower)
+
+
+@functools.cache
+def _sketchtable():
+    # The lower and upper bounds of every bucket, and its values estimated by the geometric middle of its range.
+    lowers, uppers = numpy.array([_sketchbounds(bin) for bin in range(2 * _sketchmagnitudes + 1)]).T
+    return lowers, uppers, numpy.sign(lowers + uppers) * numpy.sqrt(lowers * uppers)
+
+
+def _slice(context):
+    # Create compact, picklable copies of the context, without modules or datasets.
+    slices = Namespace(datasets={}, layers={}, previews={})
+
+    for dataset in context.datasets:
+        slices.datasets[dataset.slug] = Namespace(name=dataset.name, slug=dataset.slug, url=dataset.url)
+
+    for layer in context.model.layers:
+        slices.layers[layer.index] = Namespace(
+            conv=layer.conv,
+            index=layer.index,
+            name=layer.name,
+            nexturl=layer.nexturl,
+            prevurl=layer.prevurl,
+            type=layer.type,
+            url=layer.url,
+            )
+
+        # Channel previews only show the first few samples from the first dataset.
+        for channel in layer.channels:
+            slices.previews[(layer.index, channel.index)] = _slicechannel(slices, channel, datasets=1, samples=3)
+
+    return slices
+
+
+def _slicechannel(slices, channel, *, correlations=False, datasets=None, samples=None, statistics=False):
+    # Optional fields are always present, since missing attributes are slow to look up in templates.
+    return Namespace(
+        activations=[Namespace(
+            dataset=slices.datasets[activations.dataset.slug],
+            samples=activations.samples[:samples],
+            spatial=None,
+            sprite=None,
+            values=activations.values[:samples],
+            ) for activations in channel.activations[:datasets]],
+        correlations=[Namespace(
+            channels=[Namespace(**partner) for partner in correlations.channels],
+            dataset=slices.datasets[correlations.dataset.slug],
+            values=correlations.values,
+            ) for correlations in channel.correlations] if correlations else [],
+        index=channel.index,
+        name=channel.name,
+        nexturl=channel.nexturl,
+        prevurl=channel.prevurl,
+        statistics=[Namespace(**dict(stats, dataset=slices.datasets[stats.dataset.slug])) for stats in channel.statistics] if statistics else [],
+        url=channel.url,
+        )
+
+
+def _slug(name):
+    return re.sub(r"[^a-z0-9]+", "-", name.lower()).strip("-")
+
+
+def _statistics(values):
+    # Per-channel statistics for a batch of values, in the form kept by _mergestatistics().
+    values = values.double()
+    mean = values.mean(dim=0)
+    histogram = torch.zeros((values.shape[1], 2 * _sketchmagnitudes + 1), dtype=torch.int64)
+    bins = _sketchbins(values).T
+    histogram.scatter_add_(1, bins, torch.ones_like(bins))
+    return Namespace(
+        statscount=torch.full((values.shape[1],), len(values), dtype=torch.int64),
+        statsmean=mean,
+        statsm2=torch.sum((values - mean) ** 2, dim=0),
+        statszeros=torch.sum(values == 0, dim=0),
+        statsmin=torch.amin(values, dim=0),
+        statsmax=torch.amax(values, dim=0),
+        statshistogram=histogram,
+        )
+
+
+def _spriteposition(index, count):
+    # Background positions are percentages of the difference between the sprite and element sizes.
+    return round(index * 100 / (count - 1), 4) if count > 1 else 0
+
+
+def _subsample(evaluate, view, targets, count, generator):
+    # Randomly choose a subset of samples, keeping them in their original order.
+    if count is None:
+        return evaluate, view, targets
+    weights = torch.ones(len(view))
+    indices = torch.sort(torch.multinomial(weights, min(len(view), count), generator=generator))[0]
+    return torch.utils.data.Subset(evaluate, indices), torch.utils.data.Subset(view, indices), [targets[index] for index in indices.tolist()]
+
+
+@functools.cache
+def _template(name):
+    return _environment().get_template(name)
+
+
+def _thumbnailsource(source, thumbnails):
+    return f"{source}:{thumbnails.format}:{thumbnails.quality}:{thumbnails.size}"
+
+
+def _topk(values, examples, *, chunksize=4096):
+    # Select each channel's top-k samples with ties broken by sample index, like _mergetopk, but without sorting every
+    # sample.  Every sample above the k-th value is selected, along with the earliest samples equal to it.
+    count = min(examples, len(values))
+    if not count:
+        return values[:0], torch.empty((0, values.shape[1]), dtype=torch.int64)
+    threshold = torch.topk(values, count, dim=0, sorted=False).values.amin(dim=0)
+
+    # Work through the samples in chunks, so the masks stay small.  Only channels with more than k samples at or above
+    # the k-th value, such as dead channels, need their ties counted.
+    candidates = sum((values[offset:offset + chunksize] >= threshold).sum(dim=0, dtype=torch.int32) for offset in range(0, len(values), chunksize))
+    tied = torch.nonzero(candidates > count).flatten()
+    remaining = torch.full((len(tied),), count, dtype=torch.int32)
+    for offset in range(0, len(values), chunksize):
+        remaining -= (values[offset:offset + chunksize, tied] > threshold[tied]).sum(dim=0, dtype=torch.int32)
+    rows, columns = [], []
+    for offset in range(0, len(values), chunksize):
+        chunk = values[offset:offset + chunksize]
+        selected = chunk >= threshold
+        if len(tied):
+            ties = chunk[:, tied] == threshold[tied]
+            selected[:, tied] = (chunk[:, tied] > threshold[tied]) | (ties & (torch.cumsum(ties, dim=0) <= remaining))
+            remaining -= ties.sum(dim=0, dtype=torch.int32)
+        row, column = torch.nonzero(selected, as_tuple=True)
+        rows.append(row + offset)
+        columns.append(column)
+
+    # Group the selected samples by channel, keeping them in sample order, then rank them.
+    rows = torch.cat(rows)[torch.argsort(torch.cat(columns), stable=True)]
+    samples = rows.reshape(values.shape[1], count).T
+    values, order = _mergetopk(torch.gather(values, 0, samples), count)
+    return values, torch.gather(samples, 0, order)
+
+
+def _unwrap(dataset):
+    while isinstance(dataset, torch.utils.data.Subset):
+        dataset = dataset.dataset
+    return dataset
+
+
+def _writefile(targetdir, path, content, entry, *, digest=None):
+    # Skip unchanged files, and write changed files atomically so interrupted runs never leave partial files.
+    digest = hashlib.sha256(content).hexdigest() if digest is None else digest
+    filepath = os.path.join(targetdir, path)
+    if not _current(targetdir, entry, digest):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        temppath = f"{filepath}.{os.getpid()}"
+        with open(temppath, "wb") as stream:
+            stream.write(content)
+        os.replace(temppath, filepath)
+    return _fileentry(targetdir, path, digest=digest)
+
+
+def _writestream(targetdir, path, chunks, entry):
+    # Stream text to a temporary file while hashing it, keeping the existing file if its content is unchanged.
+    filepath = os.path.join(targetdir, path)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    temppath = f"{filepath}.{os.getpid()}"
+    hash = hashlib.sha256()
+    with open(temppath, "wb") as stream:
+        for chunk in chunks:
+            chunk = chunk.encode()
+            hash.update(chunk)
+            stream.write(chunk)
+    digest = hash.hexdigest()
+    if _current(targetdir, entry, digest):
+        os.remove(temppath)
+    else:
+        os.replace(temppath, filepath)
+    return _fileentry(targetdir, path, digest=digest)
+
+
+def caltech101(path, count, generator, *, name=None):
+    evaluate = Pipeline(torchvision.datasets.Caltech101(path))
+
+    dictionary = [item for item in evaluate.dataset.categories]
 
     view = torchvision.datasets.Caltech101(
         path,
@@ -53,24 +1389,22 @@ def caltech101(path, count, generator):
         target_transform=map_classes(dictionary),
         )
 
-
-    if count is not None:
-        weights = torch.ones(len(view))
-        indices = torch.sort(torch.multinomial(weights, min(len(view), count), generator=generator))[0]
-        evaluate = torch.utils.data.Subset(evaluate, indices)
-        view = torch.utils.data.Subset(view, indices)
+    evaluate, view, targets = _subsample(evaluate, view, list(evaluate.dataset.y), count, generator)
 
     return Namespace(
-        name="Caltech 101",
-        slug="caltech101",
+        name="Caltech 101" if name is None else name,
+        slug="caltech101" if name is None else _slug(name),
+        classnames=dictionary,
         evaluate=evaluate,
+        targets=targets,
         view=view,
         )
 
 
-def createcontext(*, batchsize, channelnames, datasets, device, examples, model, title, webroot):
+def createcontext(*, batchsize, cachedir=None, channelnames, channelslast=False, correlationlayers=None, correlations=False, datasets, device, examples, imagecallback=None, layers=None, model, neighbordims=64, neighborlayers=None, neighbors=0, overlap=False, precision="fp32", prefetch=2, profile=None, shard=None, spatial=False, statistics=False, streaming=False, thumbnailformat="webp", title, tracedir=None, webroot, workers=0):
     # Create the global context.
     context = Namespace(
+        channelnames=channelnames,
         datasets=datasets,
         model=Namespace(layers=[]),
         title=title,
@@ -79,28 +1413,29 @@ def createcontext(*, batchsize, channelnames, datasets, device, examples, model,
     )
 
     # Expand the dataset model.
-    for dataset in context.datasets:
-        log.info(f"Scanning dataset {dataset.name}")
-        dataset.samples = []
-        dataset.url = f"{webroot}datasets/{dataset.slug}"
-
-        categories = set()
-        counter = enlighten.get_manager().counter(total=len(dataset.view), desc="Scan", unit="samples", leave=False)
-        for index in range(len(dataset.view)):
-            x, y = dataset.view[index]
-            categories.add(y)
-
-            dataset.samples.append(Namespace(
-                activations=[],
-                category=Namespace(index=y[0], name=y[1]),
-                imageurl=f"{webroot}datasets/{dataset.slug}/samples/{index}/image.png",
-                index=index,
-                name=f"Sample {index}",
-                url=f"{webroot}datasets/{dataset.slug}/samples/{index}",
-                ))
-            counter.update()
-        dataset.categories = [Namespace(index=index, name=name) for index, name in categories]
-        counter.close()
+    with _phase(profile, "scan"):
+        for dataset in context.datasets:
+            log.info(f"Scanning dataset {dataset.name}")
+            dataset.url = f"{webroot}datasets/{dataset.slug}"
+
+            # Read categories from the dataset metadata when possible, instead of loading every sample.
+            if "targets" in dataset.keys():
+                targets = numpy.asarray(dataset.targets, dtype=numpy.int64)
+                classnames = {index: dataset.classnames[index] for index in numpy.unique(targets).tolist()}
+            else:
+                targets = numpy.empty(len(dataset.view), dtype=numpy.int64)
+                classnames = {}
+                counter = enlighten.get_manager().counter(total=len(dataset.view), desc="Scan", unit="samples", leave=False)
+                for index in range(len(dataset.view)):
+                    x, y = dataset.view[index]
+                    targets[index] = y[0]
+                    classnames[y[0]] = y[1]
+                    counter.update()
+                counter.close()
+
+            dataset.samples = _Samples(targets, classnames, _thumbnailextensions[thumbnailformat], f"{webroot}datasets/{dataset.slug}/samples")
+            _profilecount(profile, samples=len(targets))
+            dataset.categories = [Namespace(index=index, name=name) for index, name in sorted(classnames.items())]
 
     # Create the layer model.
     for name, module in model.named_modules():
@@ -110,6 +1445,9 @@ def createcontext(*, batchsize, channelnames, datasets, device, examples, model,
         if isinstance(module, torch.nn.Sequential):
             continue
 
+        if not _selected(name, layers):
+            continue
+
         index = len(context.model.layers)
 
         layer = Namespace(
@@ -129,99 +1467,346 @@ def createcontext(*, batchsize, channelnames, datasets, device, examples, model,
 
         context.model.layers.append(layer)
 
+    if not context.model.layers:
+        raise ValueError(f"No layers match {layers}")
+
     # Add layer navigation fields.
     for layer in context.model.layers:
         layer.nexturl=f"{webroot}layers/{(layer.index+1) % len(context.model.layers)}"
         layer.prevurl=f"{webroot}layers/{(layer.index-1) % len(context.model.layers)}"
 
+    # Optionally index the samples of some layers by the similarity of their activations.
+    indexed = {layer.index for layer in context.model.layers if neighbors and _selected(layer.name, neighborlayers)}
+
+    # Optionally accumulate the covariance of some layers' channels.
+    correlated = {layer.index for layer in context.model.layers if correlations and _selected(layer.name, correlationlayers)}
+    projections = {}
+
     # Compute activations.
-    model.to(device)
+    model.to(device, memory_format=torch.channels_last if channelslast else torch.contiguous_format)
 
     def hook_fn(layer, module, inputs, outputs):
         layer.nchannels = outputs.shape[1]
+        locations = maps = None
         if outputs.ndim == 2:
-            layer.activations[-1].values.append(outputs.detach().cpu())
+            values = outputs.detach().clone()
         elif outputs.ndim == 4:
-            layer.activations[-1].values.append(torch.amax(outputs, dim=(2, 3)).detach().cpu())
+            values = torch.amax(outputs, dim=(2, 3)).detach()
+            if spatial:
+                # Keep where each channel fired, and a coarse heatmap, which are discarded unless the sample is in the channel's top-k.
+                locations = torch.argmax(outputs.detach().flatten(2), dim=2)
+                maps = torch.nn.functional.adaptive_max_pool2d(outputs.detach(), _heatmapsize)
+        else:
+            return
+
+        # Outputs may be modified in-place by later modules, so they're copied or reduced on the device here, while
+        # waiting for the transfer and accumulating the results happen in the background.
+        if stage is None:
+            accumulate(layer, values, locations, maps, None)
+            return
+        event = None
+        if values.device.type == "cuda":
+            values, locations, maps = (None if item is None else item.to("cpu", non_blocking=True) for item in (values, locations, maps))
+            event = torch.cuda.Event()
+            event.record()
+        stage.submit(accumulate, layer, values, locations, maps, event)
+
+    def accumulate_fn(layer, values, locations, maps, event):
+        if event is not None:
+            event.synchronize()
+        values = values.float().cpu()
+        if maps is not None:
+            locations, maps = locations.int().cpu(), maps.half().cpu()
+
+        activations = layer.activations[-1]
+        if streaming or spatial:
+            # Keep only the running top-k for each channel.
+            _accumulatetopk(activations, values, examples, locations=locations, maps=maps)
+            activations.count += len(values)
+        if streaming:
+            # Keep only the top channels for each sample.
+            top = torch.topk(values, min(10, values.shape[1]), dim=1)
+            activations.samplevalues.append(top.values)
+            activations.samplechannels.append(top.indices)
+        else:
+            activations.values.append(values)
+        if statistics:
+            _mergestatistics(activations, _statistics(values))
+        if layer.index in correlated:
+            _mergecovariance(activations, _covariance(values))
+        if activations.vectors is not None:
+            # Optionally compress the vectors with a seeded random projection, so every run and shard projects them the same way.
+            if neighbordims is not None and values.shape[1] > neighbordims:
+                if layer.index not in projections:
+                    generator = torch.Generator().manual_seed(layer.index)
+                    projections[layer.index] = torch.randn((values.shape[1], neighbordims), generator=generator) / math.sqrt(neighbordims)
+                values = values @ projections[layer.index]
+            activations.vectors.append(values)
+
+    def profiled_fn(key, fn, layer, *args):
+        # Measure the cost of each layer's hook, and of accumulating its activations, which may happen in the background.
+        start = time.perf_counter()
+        try:
+            return fn(layer, *args)
+        finally:
+            profile["layers"][layer.name][key] += time.perf_counter() - start
+            if key == "hookseconds":
+                profile["layers"][layer.name]["calls"] += 1
+
+    hook = hook_fn if profile is None else functools.partial(profiled_fn, "hookseconds", hook_fn)
+    accumulate = accumulate_fn if profile is None else functools.partial(profiled_fn, "accumulateseconds", accumulate_fn)
+    if profile is not None:
+        for layer in context.model.layers:
+            profile.setdefault("layers", {}).setdefault(layer.name, {"accumulateseconds": 0.0, "calls": 0, "hookseconds": 0.0})
+
+    stage = None
+
+    # When only some layers are selected, stop each forward pass once all of them have run.
+    fired = set()
+
+    def reset_fn(module, inputs):
+        fired.clear()
+
+    def exit_fn(layer, module, inputs, outputs):
+        fired.add(layer.index)
+        if len(fired) == len(context.model.layers):
+            raise _EarlyExit()
+
+    modelhash = _modelhash(model) if cachedir is not None else None
+    fields = ["samplevalues", "samplechannels"] if streaming else ["values"]
+    if streaming or spatial:
+        fields += ["channelvalues", "channelsamples"]
+    if spatial:
+        fields += ["channellocations", "channelmaps"]
+    if statistics:
+        fields += _statisticsfields
+    if correlated:
+        fields += _covariancefields
+    if indexed:
+        fields += ["vectors"]
+    mode = f"streaming={streaming} precision={precision} channelslast={channelslast}"
+    # Cached top-k samples for each channel depend on the number of examples.
+    if "channelvalues" in fields:
+        mode += f" examples={examples}"
+    if layers is not None:
+        mode += f" layers={[layer.name for layer in context.model.layers]}"
+    if spatial:
+        mode += " spatial=True"
+    if statistics:
+        mode += " statistics=True"
+    if correlated:
+        mode += f" correlations={[layer.name for layer in context.model.layers if layer.index in correlated]}"
+    if indexed:
+        mode += f" neighbors={[layer.name for layer in context.model.layers if layer.index in indexed]} neighbordims={neighbordims}"
+
+    # Measure receptive fields, for cropping the top samples of each channel.
+    if spatial:
+        with _phase(profile, "receptivefields"):
+            receptivefields = _receptivefields(model, context.model.layers, context.datasets[0].evaluate[0][0])
+        for layer in context.model.layers:
+            layer.receptivefield = receptivefields.get(layer.index)
+
+    if shard is not None and cachedir is None:
+        raise ValueError("Sharded evaluation requires a cache directory.")
+    if shard is not None and not 0 <= shard[0] < shard[1]:
+        raise ValueError(f"Invalid shard {shard[0]} of {shard[1]}.")
 
     for dataset in context.datasets:
+        # Reuse cached activations when the model, dataset, and preprocessing are unchanged.
+        if cachedir is not None:
+            key = _activationkey(modelhash, dataset, mode)
+            if shard is not None:
+                key = _shardkey(key, shard)
+            with _phase(profile, "cache"):
+                cached = _loadactivations(cachedir, key, context.model.layers)
+            if cached is not None:
+                log.info(f"Loading cached activations for dataset {dataset.name}")
+                for layer in context.model.layers:
+                    layer.nchannels = cached[layer.name].nchannels
+                    layer.activations.append(Namespace(**{"channellocations": None, "channelmaps": None, "vectors": None, **dict.fromkeys(_statisticsfields + _covariancefields), **cached[layer.name].arrays}, dataset=dataset))
+                continue
+
         log.info(f"Generating activations for dataset {dataset.name}")
 
         handles = []
         for layer in context.model.layers:
-            layer.activations.append(Namespace(dataset=dataset, values=[]))
-            handles.append(layer.module.register_forward_hook(functools.partial(hook_fn, layer)))
-
-        counter = enlighten.get_manager().counter(total=math.ceil(len(dataset.evaluate) / batchsize), desc="Evaluate", unit="batches", leave=False)
-        loader = torch.utils.data.DataLoader(dataset.evaluate, batch_size=batchsize, shuffle=False)
-        for x, y in loader:
-            x = (item.to(device) for item in x)
-            y_hat = model(*x)
-            counter.update()
-        counter.close()
+            vectors = [] if layer.index in indexed else None
+            if streaming:
+                layer.activations.append(Namespace(dataset=dataset, channellocations=None, channelmaps=None, channelvalues=None, channelsamples=None, count=0, samplevalues=[], samplechannels=[], vectors=vectors, **dict.fromkeys(_statisticsfields + _covariancefields)))
+            else:
+                layer.activations.append(Namespace(dataset=dataset, channellocations=None, channelmaps=None, channelvalues=None, channelsamples=None, count=0, values=[], vectors=vectors, **dict.fromkeys(_statisticsfields + _covariancefields)))
+            handles.append(layer.module.register_forward_hook(functools.partial(hook, layer)))
+            if layers is not None:
+                handles.append(layer.module.register_forward_hook(functools.partial(exit_fn, layer)))
+        if layers is not None:
+            handles.append(model.register_forward_pre_hook(reset_fn))
+
+        # Sharded runs evaluate a contiguous range of whole batches, so results match an unsharded run exactly.
+        evaluated = dataset
+        if shard is not None:
+            batches = math.ceil(len(dataset.evaluate) / batchsize)
+            begin = min(len(dataset.evaluate), batches * shard[0] // shard[1] * batchsize)
+            end = min(len(dataset.evaluate), batches * (shard[0] + 1) // shard[1] * batchsize)
+            evaluated = Namespace(**dict(vars(dataset), evaluate=torch.utils.data.Subset(dataset.evaluate, range(begin, end))))
+
+        # Optionally overlap reducing activations with the forward pass, keeping a few batches in flight.
+        stage = _BackgroundStage(4 * len(context.model.layers)) if overlap else None
+        start = time.perf_counter()
+        # Optionally trace the forward pass for viewing in Perfetto or chrome://tracing.
+        tracer = None
+        if tracedir is not None:
+            def trace_fn(tracer):
+                log.info(f"Saving forward pass trace for dataset {dataset.name}")
+                os.makedirs(tracedir, exist_ok=True)
+                tracer.export_chrome_trace(os.path.join(tracedir, f"forward-{dataset.slug}.json"))
+
+            # Skip the first batch, which includes starting the data loader, and trace a few batches after a warmup, so traces stay small.
+            tracer = torch.profiler.profile(
+                activities=[torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if device.type == "cuda" else []),
+                on_trace_ready=trace_fn,
+                schedule=torch.profiler.schedule(wait=1, warmup=1, active=3, repeat=1),
+                )
+        with _phase(profile, "forward"), contextlib.nullcontext() if tracer is None else tracer:
+            try:
+                _evaluate(evaluated, model, batchsize=batchsize, channelslast=channelslast, device=device, imagecallback=imagecallback, precision=precision, prefetch=prefetch, tracer=tracer, workers=workers)
+            finally:
+                if stage is not None:
+                    stage.close()
+        elapsed = time.perf_counter() - start
+        _profilecount(profile, phase="forward", samples=len(evaluated.evaluate))
+        batches = math.ceil(len(evaluated.evaluate) / batchsize)
+        log.info(f"Extracted activations from {batches} batches in {elapsed:.1f}s ({batches / elapsed:.2f} batches/s, overlap {'on' if overlap else 'off'})")
 
         for handle in handles:
             handle.remove()
 
         for layer in context.model.layers:
-            layer.activations[-1].values = torch.cat(layer.activations[-1].values)
+            activations = layer.activations[-1]
+            # Shards past the last batch evaluate no samples, and save empty arrays.
+            empty = torch.empty((0, layer.nchannels))
+            if streaming:
+                activations.samplevalues = torch.cat(activations.samplevalues) if activations.samplevalues else empty
+                activations.samplechannels = torch.cat(activations.samplechannels) if activations.samplechannels else empty.long()
+            else:
+                activations.values = torch.cat(activations.values) if activations.values else empty
+            if activations.vectors is not None:
+                activations.vectors = torch.cat(activations.vectors) if activations.vectors else empty
+
+        if cachedir is not None:
+            log.info(f"Caching activations for dataset {dataset.name}")
+            with _phase(profile, "cache"):
+                _saveactivations(cachedir, key, context.model.layers, fields, shard=None if shard is None else {"begin": begin, "count": shard[1], "end": end, "examples": examples, "index": shard[0]})
+
+    if shard is not None:
+        return context
 
     # Create the channel model.
     for layer in context.model.layers:
-        for index in range(layer.nchannels):
-            layer.channels.append(Namespace(
-                index=index,
-                name=channelnames[layer.name][index] if layer.name in channelnames else f"Channel {index}",
-                url=f"{webroot}layers/{layer.index}/channels/{index}",
-                nexturl=f"{webroot}layers/{layer.index}/channels/{(index+1) % layer.nchannels}",
-                prevurl = f"{webroot}layers/{layer.index}/channels/{(index-1) % layer.nchannels}",
-                ))
-
-    # Assign activations to channels.
-    for layer in context.model.layers:
-        for channel in layer.channels:
-            channel.activations = []
+        layer.channels = _Channels(layer.nchannels, channelnames.get(layer.name), f"{webroot}layers/{layer.index}/channels")
+
+    with _phase(profile, "topk"):
+        # Rank activations for each channel and each sample.
+        if not streaming:
+            for layer in context.model.layers:
+                for activations in layer.activations:
+                    # Spatial runs already have the running top-k for each channel, matching their spatial data.
+                    # Ties are broken by sample index, the same way as streaming runs.
+                    if not spatial:
+                        activations.channelvalues, activations.channelsamples = _topk(activations.values, examples)
+                    activations.samplevalues, activations.samplechannels = torch.topk(activations.values, min(10, layer.nchannels), dim=1)
+
+        # Assign activations to channels and dataset samples, which are read lazily by their views.
+        for layer in context.model.layers:
             for activations in layer.activations:
-                values = activations.values.T[channel.index]
-                samples = torch.argsort(values, descending=True)[:examples]
-                channel.activations.append(Namespace(
-                    dataset=activations.dataset,
-                    samples=[activations.dataset.samples[index] for index in samples],
-                    values=values[samples].tolist(),
-                ))
-
-    # Assign activations to dataset samples.
-    for layer in context.model.layers:
-        if not len(layer.channels):
-            continue
-        for activations in layer.activations:
-            for sample, values in zip(activations.dataset.samples, activations.values):
-                channels = torch.argsort(values, descending=True)[:10]
-                sample.activations.append(Namespace(
-                    layer=layer,
-                    channels=[layer.channels[index] for index in channels],
-                    values = values[channels].tolist(),
-                    ))
+                layer.channels.activations.append((activations.dataset, activations.channelsamples, activations.channelvalues))
+                if activations.statscount is not None:
+                    layer.channels.statistics.append((activations.dataset, activations))
+                if len(layer.channels):
+                    activations.dataset.samples.activations.append((layer, activations.samplechannels, activations.samplevalues))
+
+    # Summarize the correlations between each layer's channels.
+    with _phase(profile, "correlations"):
+        for layer in context.model.layers:
+            for activations in layer.activations:
+                if activations.corrcount is not None and len(layer.channels):
+                    _correlations(activations)
+                    layer.channels.correlations.append((activations.dataset, activations))
+
+    # Find the most similar samples in each dataset, for each indexed layer.
+    with _phase(profile, "neighbors"):
+        for layer in context.model.layers:
+            if layer.index not in indexed:
+                continue
+            for activations in layer.activations:
+                log.info(f"Finding similar samples for layer {layer.name} in dataset {activations.dataset.name}")
+                activations.neighborsamples, activations.neighborvalues = _nearestneighbors(activations.vectors, neighbors)
+                activations.dataset.samples.neighbors.append((layer, activations.neighborsamples, activations.neighborvalues))
 
     return context
 
 
 def generate(*,
     batchsize,
+    bundle=None,
+    cachedir=None,
     channelnames,
+    channelslast=False,
     clean,
+    correlationlayers=None,
+    correlations=False,
     datasets,
     device,
     examples,
+    jobs=1,
+    layers=None,
+    mode="pages",
     model,
+    neighbordims=64,
+    neighborlayers=None,
+    neighbors=0,
+    overlap=False,
+    precision="fp32",
+    prefetch=2,
+    profile=None,
+    shard=None,
+    spatial=False,
+    sprites=False,
+    statistics=False,
+    store=None,
+    streaming=False,
     targetdir,
+    thumbnailformat="webp",
+    thumbnailquality=80,
+    thumbnailsize=96,
     title,
+    trace=False,
     webroot,
+    workers=0,
     ):
+    start = time.perf_counter()
+    tracedir = os.path.join(targetdir, "profile") if trace else None
+    _checkslugs(datasets)
+    options = dict(batchsize=batchsize, correlations=correlations, examples=examples, jobs=jobs, layers=layers, mode=mode, neighbors=neighbors, overlap=overlap, precision=precision, shard=shard, spatial=spatial, sprites=sprites, statistics=statistics, streaming=streaming, workers=workers)
+
+    # Sharded runs only compute activations, and the site is generated after merging them.
+    if shard is not None:
+        log.info(f"Generating activations for deep visualization {title}, shard {shard[0]} of {shard[1]}.")
+        createcontext(batchsize=batchsize, cachedir=cachedir, channelnames=channelnames, channelslast=channelslast, correlationlayers=correlationlayers, correlations=correlations, datasets=datasets, device=device, examples=examples, layers=layers, model=model, neighbordims=neighbordims, neighborlayers=neighborlayers, neighbors=neighbors, overlap=overlap, precision=precision, prefetch=prefetch, profile=profile, shard=shard, spatial=spatial, statistics=statistics, streaming=streaming, thumbnailformat=thumbnailformat, title=title, tracedir=tracedir, webroot=webroot, workers=workers)
+        if profile is not None:
+            _profilereport(profile, elapsed=time.perf_counter() - start, options=options)
+            _writefile(targetdir, "profile/profile.json", json.dumps(profile, indent=2, sort_keys=True).encode(), None)
+        return
+
     log.info(f"Generating deep visualization {title} in {targetdir}.")
 
-    # Create the object model that will be used by Jinja templates.
-    context = createcontext(batchsize=batchsize, channelnames=channelnames, datasets=datasets, device=device, examples=examples, model=model, title=title, webroot=webroot)
+    if mode not in ["pages", "shards"]:
+        raise ValueError(f"Unsupported mode: {mode}")
+    # The client-side viewer doesn't display these, so computing them would be wasted work.
+    if mode == "shards" and (correlations or neighbors or spatial or statistics):
+        raise ValueError("Correlations, neighbors, spatial data, and statistics are only displayed in pages mode.")
+    if thumbnailformat not in _thumbnailextensions:
+        raise ValueError(f"Unsupported thumbnail format: {thumbnailformat}")
+    thumbnails = Namespace(extension=_thumbnailextensions[thumbnailformat], format=thumbnailformat, quality=thumbnailquality, size=thumbnailsize)
 
     # Optionally remove the target directory.
     if clean and os.path.exists(targetdir):
@@ -233,92 +1818,270 @@ def generate(*,
     if not os.path.exists(targetdir):
         os.makedirs(targetdir)
 
-    # Copy assets to the target directory.
-    log.info(f"Copying assets to {targetdir}")
-    shutil.copytree(os.path.join(__path__[0], "templates", "css"), os.path.join(targetdir, "css"), dirs_exist_ok=True)
-    shutil.copytree(os.path.join(__path__[0], "templates", "js"), os.path.join(targetdir, "js"), dirs_exist_ok=True)
-
-    environment = jinja2.Environment(
-        loader=jinja2.PackageLoader("samlab.deepvis"),
-        autoescape=jinja2.select_autoescape(),
+    # Load the manifest of previously generated files, and log new entries as they're written so interrupted runs can resume.
+    manifest = _loadmanifest(targetdir)
+    written = {}
+    manifeststream = open(os.path.join(targetdir, "manifest.jsonl"), "a")
+
+    def record(entries, phase=None):
+        for entry in entries:
+            written[entry["path"]] = entry
+            manifeststream.write(json.dumps(entry) + "\n")
+            # Files with unchanged manifest entries were skipped rather than written.
+            if manifest.get(entry["path"]) == entry:
+                _profilecount(profile, phase=phase, unchanged=1)
+            else:
+                _profilecount(profile, phase=phase, bytes=entry["size"], files=1)
+        manifeststream.flush()
+
+    # Optionally shard page rendering and image encoding across worker processes.
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("spawn")) if jobs > 1 else None
+    pending = {}
+
+    def submit(counter, count, fn, *args):
+        if pool is None:
+            record(fn(*args))
+            if counter is not None:
+                counter.update(count)
+            return
+        # Output is attributed to the phase that submitted the work, not the one that's running when it finishes.
+        pending[pool.submit(fn, *args)] = (counter, count, _phasestack[-1][0] if _phasestack else None)
+        wait(2 * jobs)
+
+    def wait(limit):
+        while len(pending) > limit:
+            done, notdone = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                counter, count, phase = pending.pop(future)
+                record(future.result(), phase)
+                if counter is not None:
+                    counter.update(count)
+
+    # Skip decoding images that are already current.  Images are identified by their dataset and index, and by their
+    # file's size and modification time, so replacing an image on disk encodes it again.
+    sources = {dataset.slug: _datasetkey(dataset) for dataset in datasets}
+    files = {dataset.slug: _samplefiles(dataset) for dataset in datasets}
+
+    def samplesource(slug, index):
+        size, mtime = files[slug][index]
+        return f"{sources[slug]}:{index}:{size}:{mtime}"
+
+    def imageentries(dataset, indices):
+        return [(
+            manifest.get(f"datasets/{dataset.slug}/samples/{index}/image.png"),
+            manifest.get(f"datasets/{dataset.slug}/samples/{index}/thumbnail.{thumbnails.extension}"),
+            ) for index in indices]
+
+    saved = set()
+    with _phase(profile, "images"):
+        for dataset in datasets:
+            entries = imageentries(dataset, range(len(dataset.evaluate)))
+            if all(_current(targetdir, imageentry, samplesource(dataset.slug, index)) and _current(targetdir, thumbnailentry, _thumbnailsource(samplesource(dataset.slug, index), thumbnails)) for index, (imageentry, thumbnailentry) in enumerate(entries)):
+                saved.add(dataset.slug)
+                record(itertools.chain.from_iterable(entries))
+
+    # Save images and thumbnails as they're decoded for evaluation.
+    def imagecallback(dataset, offset, images):
+        if dataset.slug in saved:
+            return
+        indices = range(offset, offset + len(images))
+        with _phase(profile, "images"):
+            submit(None, 0, _saveimages, targetdir, dataset.slug, offset, images.numpy(), [samplesource(dataset.slug, index) for index in indices], imageentries(dataset, indices), thumbnails, store)
+            _profilecount(profile, samples=len(images))
+        if offset + len(images) == len(dataset.evaluate):
+            saved.add(dataset.slug)
+
+    try:
+        # Create the object model that will be used by Jinja templates.
+        context = createcontext(batchsize=batchsize, cachedir=cachedir, channelnames=channelnames, channelslast=channelslast, correlationlayers=correlationlayers, correlations=correlations, datasets=datasets, device=device, examples=examples, imagecallback=imagecallback, layers=layers, model=model, neighbordims=neighbordims, neighborlayers=neighborlayers, neighbors=neighbors, overlap=overlap, precision=precision, prefetch=prefetch, profile=profile, spatial=spatial, statistics=statistics, streaming=streaming, thumbnailformat=thumbnailformat, title=title, tracedir=tracedir, webroot=webroot, workers=workers)
+        if trace:
+            record([_fileentry(targetdir, f"profile/forward-{dataset.slug}.json") for dataset in context.datasets if os.path.exists(os.path.join(tracedir, f"forward-{dataset.slug}.json"))], "forward")
+
+        # Save images for datasets that weren't evaluated, e.g. because their activations were cached.
+        with _phase(profile, "images"):
+            for dataset in context.datasets:
+                if dataset.slug not in saved:
+                    log.info(f"Saving images for dataset {dataset.name}")
+                    _decodeimages(dataset, imagecallback, batchsize=batchsize, device=device, prefetch=prefetch, workers=workers)
+
+            # Sprite sheets are built from the thumbnails, so they must be finished first.
+            wait(0)
+
+        # Copy assets to the target directory.
+        log.info(f"Copying assets to {targetdir}")
+        with _phase(profile, "assets"):
+            shutil.copytree(os.path.join(__path__[0], "templates", "css"), os.path.join(targetdir, "css"), dirs_exist_ok=True)
+            shutil.copytree(os.path.join(__path__[0], "templates", "js"), os.path.join(targetdir, "js"), dirs_exist_ok=True)
+
+        # Optionally write data shards for the client-side viewer instead of pages.
+        with _phase(profile, "render"):
+            if mode == "shards":
+                log.info(f"Generating data shards.")
+                record(_renderpages(targetdir, "viewer.html", [("", dict(title=context.title, url=context.url, webroot=context.webroot), manifest.get("index.html"))]))
+                for path, content in _shards(context, thumbnails):
+                    record([_writefile(targetdir, path, content, manifest.get(path))])
+            else:
+                # Generate the home page.
+                log.info(f"Generating home page.")
+                record(_renderpages(targetdir, "index.html", [("", dict(datasets=context.datasets, model=context.model, profileurl=f"{webroot}profile" if profile is not None else None, title=context.title, url=context.url, webroot=context.webroot), manifest.get("index.html"))]))
+
+                # Pages are rendered from compact slices of the context, so they can be sent to worker processes.
+                slices = _slice(context)
+                base = dict(title=context.title, url=context.url, webroot=context.webroot)
+                chunksize = 64
+
+                # Generate per-layer pages.
+                for layer in context.model.layers:
+                    log.info(f"Generating layer {layer.name}")
+
+                    layerdir = f"layers/{layer.index}"
+                    submit(None, 0, _renderpages, targetdir, "layer.html", [(layerdir, dict(base, layer=_layerpage(slices, layer)), manifest.get(f"{layerdir}/index.html"))])
+
+                    # Generate per-channel pages.
+                    counter = enlighten.get_manager().counter(total=len(layer.channels), desc="Generate", unit="channels", leave=False)
+                    for begin in range(0, len(layer.channels), chunksize):
+                        pages = []
+                        strips = []
+                        for channel in layer.channels[begin:begin+chunksize]:
+                            channeldir = f"{layerdir}/channels/{channel.index}"
+                            page = _slicechannel(slices, channel, correlations=True, statistics=True)
+
+                            # Optionally replace each dataset's strip of thumbnails with a single sprite sheet.
+                            if sprites:
+                                for activations in page.activations:
+                                    path = f"{channeldir}/{activations.dataset.slug}.{thumbnails.extension}"
+                                    columns = min(10, len(activations.samples))
+                                    rows = math.ceil(len(activations.samples) / columns) if columns else 0
+                                    activations.sprite = Namespace(
+                                        columns=columns,
+                                        positions=[f"{_spriteposition(index % columns, columns)}% {_spriteposition(index // columns, rows)}%" for index in range(len(activations.samples))],
+                                        rows=rows,
+                                        url=f"{channel.url}/{activations.dataset.slug}.{thumbnails.extension}",
+                                        )
+                                    paths = [f"datasets/{activations.dataset.slug}/samples/{sample.index}/thumbnail.{thumbnails.extension}" for sample in activations.samples]
+                                    source = hashlib.sha256("\n".join(_thumbnailsource(samplesource(activations.dataset.slug, sample.index), thumbnails) for sample in activations.samples).encode()).hexdigest()
+                                    strips.append(("sprites", (path, paths, columns, source, manifest.get(path))))
+
+                            # Optionally add receptive field crops and heatmap overlays for each dataset's strip of samples.
+                            if spatial and layer.receptivefield is not None:
+                                for activations, layeractivations in zip(page.activations, layer.activations):
+                                    slug = activations.dataset.slug
+                                    croppath = f"{channeldir}/{slug}.crops.{thumbnails.extension}"
+                                    overlaypath = f"{channeldir}/{slug}.overlays.{thumbnails.extension}"
+                                    columns = min(10, len(activations.samples))
+                                    rows = math.ceil(len(activations.samples) / columns) if columns else 0
+                                    activations.spatial = Namespace(
+                                        columns=columns,
+                                        cropurl=f"{channel.url}/{slug}.crops.{thumbnails.extension}",
+                                        overlayurl=f"{channel.url}/{slug}.overlays.{thumbnails.extension}",
+                                        positions=[f"{_spriteposition(index % columns, columns)}% {_spriteposition(index // columns, rows)}%" for index in range(len(activations.samples))],
+                                        rows=rows,
+                                        )
+                                    paths = [f"datasets/{slug}/samples/{sample.index}/image.png" for sample in activations.samples]
+                                    boxes = [_receptivebox(layer.receptivefield, location) for location in layeractivations.channellocations[:, channel.index].tolist()]
+                                    maps = layeractivations.channelmaps[:, channel.index].float().numpy()
+                                    source = hashlib.sha256("\n".join([samplesource(slug, sample.index) for sample in activations.samples] + [repr(boxes), _thumbnailsource("", thumbnails)]).encode() + maps.tobytes()).hexdigest()
+                                    strips.append(("spatial", (croppath, overlaypath, paths, boxes, maps, columns, source, manifest.get(croppath), manifest.get(overlaypath))))
+
+                            pages.append((channeldir, dict(base, layer=slices.layers[layer.index], channel=page), manifest.get(f"{channeldir}/index.html")))
+                        submit(counter, len(pages), _renderpages, targetdir, "channel.html", pages)
+                        with _phase(profile, "images"):
+                            if any(kind == "sprites" for kind, strip in strips):
+                                submit(None, 0, _savesprites, targetdir, [strip for kind, strip in strips if kind == "sprites"], thumbnails)
+                            if any(kind == "spatial" for kind, strip in strips):
+                                submit(None, 0, _savespatial, targetdir, [strip for kind, strip in strips if kind == "spatial"], thumbnails)
+                    wait(0)
+                    counter.close()
+
+                # Generate per-dataset pages.
+                for dataset in context.datasets:
+                    log.info(f"Generating dataset {dataset.name}.")
+
+                    datasetdir = f"datasets/{dataset.slug}"
+                    record(_renderpages(targetdir, "dataset.html", [(datasetdir, dict(base, dataset=dataset), manifest.get(f"{datasetdir}/index.html"))]))
+
+                    # Generate per-sample pages.
+                    counter = enlighten.get_manager().counter(total=len(dataset.samples), desc="Generate", unit="samples", leave=False)
+                    for begin in range(0, len(dataset.samples), chunksize):
+                        pages = []
+                        for sample in dataset.samples[begin:begin+chunksize]:
+                            sampledir = f"{datasetdir}/samples/{sample.index}"
+                            pages.append((sampledir, dict(base, dataset=slices.datasets[dataset.slug], sample=_samplepage(slices, dataset, sample)), manifest.get(f"{sampledir}/index.html")))
+                        submit(counter, len(pages), _renderpages, targetdir, "sample.html", pages)
+                    wait(0)
+                    counter.close()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        manifeststream.close()
+
+    # Remove stale files from previous runs, and compact the manifest.
+    with _phase(profile, "manifest"):
+        stale = manifest.keys() - written.keys()
+        if stale:
+            log.info(f"Removing {len(stale)} stale files")
+        for path in stale:
+            filepath = os.path.join(targetdir, path)
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            try:
+                os.removedirs(os.path.dirname(filepath))
+            except OSError:
+                pass
+
+        with open(os.path.join(targetdir, "manifest.jsonl.tmp"), "w") as stream:
+            for entry in written.values():
+                stream.write(json.dumps(entry) + "\n")
+        os.replace(os.path.join(targetdir, "manifest.jsonl.tmp"), os.path.join(targetdir, "manifest.jsonl"))
+
+    # Optionally write the profile and its summary page last, so they cover every phase.  They're added to the
+    # manifest, so later runs without profiling remove them.
+    if profile is not None:
+        _profilereport(profile, elapsed=time.perf_counter() - start, options=options)
+        for name, stats in profile["phases"].items():
+            log.info(f"Phase {name}: {stats['seconds']:.2f}s, {stats['samples']} samples, {stats['files']} files, {stats['bytes']} bytes written")
+        entries = [_writefile(targetdir, "profile/profile.json", json.dumps(profile, indent=2, sort_keys=True).encode(), None)]
+        if mode == "pages":
+            entries += _renderpages(targetdir, "profile.html", [("profile", dict(layers=sorted(profile.get("layers", {}).items(), key=lambda item: -item[1]["hookseconds"]), profile=profile, title=title, url=webroot, webroot=webroot), None)])
+        with open(os.path.join(targetdir, "manifest.jsonl"), "a") as stream:
+            for entry in entries:
+                stream.write(json.dumps(entry) + "\n")
+
+    # Optionally pack the finished site into a single file.
+    if bundle is not None:
+        pack(targetdir, bundle)
+
+
+def imagefolder(path, count, generator, *, name=None):
+    evaluate = Pipeline(torchvision.datasets.ImageFolder(path))
+
+    dictionary = list(evaluate.dataset.classes)
+
+    # Share the directory scan between datasets, which matters for large trees on network filesystems.
+    view = copy.copy(evaluate.dataset)
+    view.transform = torchvision.transforms.v2.Compose([
+        torchvision.transforms.v2.CenterCrop((224, 224)),
+        lambda x: (x,),
+        ])
+    view.target_transform = map_classes(dictionary)
+
+    evaluate, view, targets = _subsample(evaluate, view, list(evaluate.dataset.targets), count, generator)
+
+    name = os.path.basename(os.path.normpath(path)) if name is None else name
+    return Namespace(
+        name=name,
+        slug=_slug(name),
+        classnames=dictionary,
+        evaluate=evaluate,
+        targets=targets,
+        view=view,
         )
 
-    # Generate the home page.
-    log.info(f"Generating home page.")
-    with open(os.path.join(targetdir, "index.html"), "w") as stream:
-        stream.write(environment.get_template("index.html").render(context))
-
-    # Generate per-layer pages.
-    for layer in context.model.layers:
-        log.info(f"Generating layer {layer.name}")
-        context.layer = layer
-
-        layerdir = os.path.join(targetdir, "layers", str(layer.index))
-        if not os.path.exists(layerdir):
-            os.makedirs(layerdir)
 
-        with open(os.path.join(layerdir, "index.html"), "w") as stream:
-            stream.write(environment.get_template("layer.html").render(context))
+def imagenet2012(path, count, generator, *, name=None):
+    evaluate = Pipeline(torchvision.datasets.ImageNet(path))
 
-        # Generate per-channel pages.
-        counter = enlighten.get_manager().counter(total=len(layer.channels), desc="Generate", unit="channels", leave=False)
-        for channel in layer.channels:
-            context.channel = channel
-
-            channeldir = os.path.join(layerdir, "channels", str(channel.index))
-            if not os.path.exists(channeldir):
-                os.makedirs(channeldir)
-
-            with open(os.path.join(channeldir, "index.html"), "w") as stream:
-                stream.write(environment.get_template("channel.html").render(context))
-
-            counter.update()
-        counter.close()
-
-    # Generate per-dataset pages.
-    for dataset in context.datasets:
-        log.info(f"Generating dataset {dataset.name}.")
-        context.dataset = dataset
-
-        datasetdir = os.path.join(targetdir, "datasets", dataset.slug)
-        if not os.path.exists(datasetdir):
-            os.makedirs(datasetdir)
-
-        with open(os.path.join(datasetdir, "index.html"), "w") as stream:
-            stream.write(environment.get_template("dataset.html").render(context))
-
-        # Generate per-sample pages.
-        counter = enlighten.get_manager().counter(total=len(dataset.samples), desc="Generate", unit="samples", leave=False)
-        for sample in dataset.samples:
-            context.sample = sample
-
-            sampledir = os.path.join(datasetdir, "samples", f"{sample.index}")
-            if not os.path.exists(sampledir):
-                os.makedirs(sampledir)
-
-            with open(os.path.join(sampledir, "index.html"), "w") as stream:
-                stream.write(environment.get_template("sample.html").render(context))
-
-            imagepath = os.path.join(sampledir, f"image.png")
-            x, y = dataset.view[sample.index]
-            x[0].save(imagepath)
-            counter.update()
-        counter.close()
-
-
-def imagenet2012(path, count, generator):
-    evaluate = torchvision.datasets.ImageNet(
-        path,
-        transform=torchvision.transforms.v2.Compose([
-            torchvision.transforms.v2.ToImage(),
-            torchvision.transforms.v2.CenterCrop((224, 224)),
-            torchvision.transforms.v2.ToDtype(torch.float32, scale=True),
-            torchvision.transforms.v2.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-            lambda x: (x,),
-            ]),
-        )
-
-    dictionary = [item[0] for item in evaluate.classes]
+    dictionary = [item[0] for item in evaluate.dataset.classes]
 
     view = torchvision.datasets.ImageNet(
         path,
@@ -329,17 +2092,14 @@ def imagenet2012(path, count, generator):
         target_transform=map_classes(dictionary),
         )
 
-
-    if count is not None:
-        weights = torch.ones(len(view))
-        indices = torch.sort(torch.multinomial(weights, min(len(view), count), generator=generator))[0]
-        evaluate = torch.utils.data.Subset(evaluate, indices)
-        view = torch.utils.data.Subset(view, indices)
+    evaluate, view, targets = _subsample(evaluate, view, list(evaluate.dataset.targets), count, generator)
 
     return Namespace(
-        name="ImageNet 2012",
-        slug="imagenet2012",
+        name="ImageNet 2012" if name is None else name,
+        slug="imagenet2012" if name is None else _slug(name),
+        classnames=dictionary,
         evaluate=evaluate,
+        targets=targets,
         view=view,
         )
 
@@ -350,19 +2110,90 @@ def map_classes(dictionary):
     return implementation
 
 
-def places365(path, count, generator):
-    evaluate = torchvision.datasets.Places365(
-        path,
-        transform=torchvision.transforms.v2.Compose([
-            torchvision.transforms.v2.ToImage(),
-            torchvision.transforms.v2.CenterCrop((224, 224)),
-            torchvision.transforms.v2.ToDtype(torch.float32, scale=True),
-            torchvision.transforms.v2.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-            lambda x: (x,),
-            ]),
-        )
+def merge(cachedir):
+    # Find complete sets of shards in the cache.
+    groups = collections.defaultdict(dict)
+    for name in os.listdir(cachedir):
+        match = re.fullmatch(r"(.+)\.shard-(\d+)-of-(\d+)", name)
+        if match and os.path.exists(os.path.join(cachedir, name, "index.json")):
+            groups[(match.group(1), int(match.group(3)))][int(match.group(2))] = name
+
+    for (key, count), names in sorted(groups.items()):
+        if len(names) != count:
+            log.warning(f"Skipping {key}, which has {len(names)} of {count} shards.")
+            continue
 
-    dictionary = ["/".join(item.split("/")[2:]) for item in evaluate.classes]
+        log.info(f"Merging {count} shards into {key}")
+        indices = []
+        for index in range(count):
+            with open(os.path.join(cachedir, names[index], "index.json"), "r") as stream:
+                indices.append(json.load(stream))
+
+        # Shards past the last batch evaluate no samples, so they have no channel counts or accumulators to merge.
+        nonempty = [index for index in range(count) if indices[index]["shard"]["begin"] < indices[index]["shard"]["end"]] or list(range(count))
+        names = [names[index] for index in nonempty]
+        indices = [indices[index] for index in nonempty]
+
+        # Sample indices within each shard are offset by the shard's first sample.
+        layers = []
+        for name, entry in indices[0]["layers"].items():
+            arrays = [{field: torch.from_numpy(numpy.load(os.path.join(cachedir, names[index], name, f"{field}.npy"), mmap_mode="c")) for field in entry["arrays"]} for index in range(len(names))]
+            activations = Namespace()
+            for field in ["values", "samplevalues", "samplechannels", "vectors"]:
+                if field in entry["arrays"]:
+                    setattr(activations, field, torch.cat([shard[field] for shard in arrays]))
+            if "statscount" in entry["arrays"]:
+                for field in _statisticsfields:
+                    setattr(activations, field, None)
+                for shard in arrays:
+                    _mergestatistics(activations, Namespace(**{field: shard[field] for field in _statisticsfields}))
+            if "corrcount" in entry["arrays"]:
+                for field in _covariancefields:
+                    setattr(activations, field, None)
+                for shard in arrays:
+                    _mergecovariance(activations, Namespace(**{field: shard[field] for field in _covariancefields}))
+            if "channelvalues" in entry["arrays"]:
+                values = torch.cat([shard["channelvalues"] for shard in arrays])
+                samples = torch.cat([shard["channelsamples"] + index["shard"]["begin"] for shard, index in zip(arrays, indices)])
+                activations.channelvalues, order = _mergetopk(values, indices[0]["shard"]["examples"])
+                activations.channelsamples = torch.gather(samples, 0, order)
+                if "channelmaps" in entry["arrays"]:
+                    activations.channellocations = torch.gather(torch.cat([shard["channellocations"] for shard in arrays]), 0, order)
+                    activations.channelmaps = _gathermaps(torch.cat([shard["channelmaps"] for shard in arrays]), order)
+            layers.append(Namespace(activations=[activations], name=name, nchannels=entry["nchannels"]))
+
+        _saveactivations(cachedir, key, layers, ["values", "samplevalues", "samplechannels", "channelvalues", "channelsamples", "channellocations", "channelmaps", "vectors"] + _statisticsfields + _covariancefields)
+
+
+def pack(targetdir, bundle):
+    """Pack a generated site into a single zip archive, which can be copied in one sequential write and served by :func:`servebundle`."""
+    log.info(f"Packing {targetdir} into {bundle}")
+    start = time.perf_counter()
+
+    # Write to a temporary file and rename it, so interrupted runs never leave a partial bundle.
+    temppath = f"{bundle}.{os.getpid()}"
+    count = 0
+    with zipfile.ZipFile(temppath, "w") as archive:
+        for dirpath, dirnames, filenames in os.walk(targetdir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                filepath = os.path.join(dirpath, filename)
+                name = os.path.relpath(filepath, targetdir).replace(os.sep, "/")
+                if name == "manifest.jsonl" or os.path.abspath(filepath) == os.path.abspath(temppath):
+                    continue
+                # Images are already compressed, and stored entries can be read without decompressing them.
+                compression = zipfile.ZIP_STORED if posixpath.splitext(name)[1] in [".jpg", ".png", ".webp"] else zipfile.ZIP_DEFLATED
+                archive.write(filepath, name, compress_type=compression)
+                count += 1
+    os.replace(temppath, bundle)
+
+    log.info(f"Packed {count} files in {time.perf_counter() - start:.1f}s")
+
+
+def places365(path, count, generator, *, name=None):
+    evaluate = Pipeline(torchvision.datasets.Places365(path))
+
+    dictionary = ["/".join(item.split("/")[2:]) for item in evaluate.dataset.classes]
 
     view = torchvision.datasets.Places365(
         path,
@@ -373,18 +2204,223 @@ def places365(path, count, generator):
         target_transform=map_classes(dictionary),
         )
 
+    evaluate, view, targets = _subsample(evaluate, view, list(evaluate.dataset.targets), count, generator)
 
+    return Namespace(
+        name="Places 365" if name is None else name,
+        slug="places365" if name is None else _slug(name),
+        classnames=dictionary,
+        evaluate=evaluate,
+        targets=targets,
+        view=view,
+        )
+
+
+def tarshards(path, count, generator, *, name=None):
+    # Accept a directory of shards, or a glob pattern matching them.
+    paths = sorted(glob.glob(os.path.join(path, "*.tar") if os.path.isdir(path) else path))
+    if not paths:
+        raise ValueError(f"No tar shards match {path}")
+
+    # Class names are optionally read from a file alongside the shards, one per line.
+    classes = None
+    if os.path.exists(os.path.join(os.path.dirname(paths[0]), "classes.txt")):
+        with open(os.path.join(os.path.dirname(paths[0]), "classes.txt"), "r") as stream:
+            classes = stream.read().splitlines()
+
+    log.info(f"Indexing {len(paths)} tar shards")
+    evaluate = Pipeline(TarShards(paths, classes=classes))
+
+    dictionary = evaluate.dataset.classes
+
+    view = copy.copy(evaluate.dataset)
+    view.transform = torchvision.transforms.v2.Compose([
+        torchvision.transforms.v2.CenterCrop((224, 224)),
+        lambda x: (x,),
+        ])
+    view.target_transform = map_classes(dictionary)
+
+    evaluate, view, targets = _subsample(evaluate, view, list(evaluate.dataset.targets), count, generator)
     if count is not None:
-        weights = torch.ones(len(view))
-        indices = torch.sort(torch.multinomial(weights, min(len(view), count), generator=generator))[0]
-        evaluate = torch.utils.data.Subset(evaluate, indices)
-        view = torch.utils.data.Subset(view, indices)
+        for dataset in [_unwrap(evaluate).dataset, _unwrap(view)]:
+            dataset._plan(evaluate.indices.tolist())
 
+    # Glob patterns are included in the default name, so e.g. train-*.tar and val-*.tar in one directory are distinct.
+    if name is None:
+        name = os.path.basename(os.path.normpath(path)) if os.path.isdir(path) else f"{os.path.basename(os.path.dirname(os.path.abspath(path)))}/{os.path.splitext(os.path.basename(path))[0]}"
     return Namespace(
-        name="Places 365",
-        slug="places365",
+        name=name,
+        slug=_slug(name),
+        classnames=dictionary,
         evaluate=evaluate,
+        targets=targets,
         view=view,
         )
 
 
+def serve(*,
+    batchsize,
+    cachedir=None,
+    channelnames,
+    channelslast=False,
+    correlationlayers=None,
+    correlations=False,
+    datasets,
+    device,
+    examples,
+    host="localhost",
+    layers=None,
+    lrusize=256 * 1024 * 1024,
+    model,
+    neighbordims=64,
+    neighborlayers=None,
+    neighbors=0,
+    overlap=False,
+    port=8000,
+    precision="fp32",
+    prefetch=2,
+    statistics=False,
+    streaming=False,
+    thumbnailformat="webp",
+    thumbnailquality=80,
+    thumbnailsize=96,
+    title,
+    workers=0,
+    ):
+    log.info(f"Serving deep visualization {title} on http://{host}:{port}/")
+    start = time.perf_counter()
+    _checkslugs(datasets)
+
+    if thumbnailformat not in _thumbnailextensions:
+        raise ValueError(f"Unsupported thumbnail format: {thumbnailformat}")
+    thumbnails = Namespace(extension=_thumbnailextensions[thumbnailformat], format=thumbnailformat, quality=thumbnailquality, size=thumbnailsize)
+
+    # Load the context once, ideally from cached activations, and render pages and images on demand.
+    context = createcontext(batchsize=batchsize, cachedir=cachedir, channelnames=channelnames, channelslast=channelslast, correlationlayers=correlationlayers, correlations=correlations, datasets=datasets, device=device, examples=examples, layers=layers, model=model, neighbordims=neighbordims, neighborlayers=neighborlayers, neighbors=neighbors, overlap=overlap, precision=precision, prefetch=prefetch, statistics=statistics, streaming=streaming, thumbnailformat=thumbnailformat, title=title, webroot="/", workers=workers)
+    slices = _slice(context)
+    base = dict(title=context.title, url=context.url, webroot=context.webroot)
+    datasets = {dataset.slug: dataset for dataset in context.datasets}
+    cache = _LRUCache(lrusize)
+
+    assets = {}
+    for assetdir in ["css", "js"]:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(__path__[0], "templates", assetdir)):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                assets["/".join([assetdir, os.path.relpath(filepath, os.path.join(__path__[0], "templates", assetdir)).replace(os.sep, "/")])] = filepath
+
+    def page(template, pagecontext):
+        return ("text/html; charset=utf-8", _template(template).render(pagecontext).encode())
+
+    def image(dataset, index, thumbnail):
+        image = PIL.Image.fromarray(numpy.ascontiguousarray(_decodeimage(dataset, index).numpy().transpose(1, 2, 0)))
+        if not thumbnail:
+            return ("image/png", _encodeimage(image, "png"))
+        image.thumbnail((thumbnails.size, thumbnails.size))
+        return (f"image/{thumbnails.format}", _encodeimage(image, thumbnails.format, quality=thumbnails.quality))
+
+    def asset(path):
+        with open(assets[path], "rb") as stream:
+            return (mimetypes.guess_type(path)[0] or "application/octet-stream", stream.read())
+
+    def resolve(path):
+        # Map a request path to a function that produces its content, or None.
+        parts = [part for part in path.split("/") if part and part != "index.html"]
+        match parts:
+            case []:
+                return functools.partial(page, "index.html", dict(base, datasets=context.datasets, model=context.model, profileurl=None))
+            case ["layers", layer] if layer.isdigit() and int(layer) < len(context.model.layers):
+                layer = context.model.layers[int(layer)]
+                return functools.partial(page, "layer.html", dict(base, layer=_layerpage(slices, layer)))
+            case ["layers", layer, "channels", channel] if layer.isdigit() and int(layer) < len(context.model.layers) and channel.isdigit() and int(channel) < context.model.layers[int(layer)].nchannels:
+                layer = context.model.layers[int(layer)]
+                return functools.partial(page, "channel.html", dict(base, layer=slices.layers[layer.index], channel=_slicechannel(slices, layer.channels[int(channel)], correlations=True, statistics=True)))
+            case ["datasets", slug] if slug in datasets:
+                return functools.partial(page, "dataset.html", dict(base, dataset=datasets[slug]))
+            case ["datasets", slug, "samples", sample] if slug in datasets and sample.isdigit() and int(sample) < len(datasets[slug].samples):
+                dataset = datasets[slug]
+                return functools.partial(page, "sample.html", dict(base, dataset=slices.datasets[slug], sample=_samplepage(slices, dataset, dataset.samples[int(sample)])))
+            case ["datasets", slug, "samples", sample, filename] if slug in datasets and sample.isdigit() and int(sample) < len(datasets[slug].samples) and filename in ["image.png", f"thumbnail.{thumbnails.extension}"]:
+                return functools.partial(image, datasets[slug], int(sample), filename != "image.png")
+            case _ if "/".join(parts) in assets:
+                return functools.partial(asset, "/".join(parts))
+        return None
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?")[0].split("#")[0]
+            fn = resolve(path)
+            if fn is None:
+                self.send_error(404)
+                return
+            contenttype, content = cache.get(path.strip("/").removesuffix("index.html").strip("/"), fn)
+            self.send_response(200)
+            self.send_header("Content-Type", contenttype)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            log.debug(format % args)
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    log.info(f"Ready in {time.perf_counter() - start:.1f}s at http://{host}:{server.server_port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def servebundle(bundle, *, host="localhost", port=8000):
+    """Serve a site packed by :func:`pack`, reading files directly from the archive."""
+    log.info(f"Serving deep visualization bundle {bundle} on http://{host}:{port}/")
+
+    # Zip archives are safe to read from multiple threads.
+    archive = zipfile.ZipFile(bundle)
+    names = set(archive.namelist())
+
+    def resolve(path):
+        path = urllib.parse.unquote(path).strip("/")
+        for name in [path, posixpath.join(path, "index.html") if path else "index.html"]:
+            if name in names:
+                return name
+        return None
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            name = resolve(self.path.split("?")[0].split("#")[0])
+            if name is None:
+                self.send_error(404)
+                return
+            content = archive.read(name)
+            contenttype = mimetypes.guess_type(name)[0] or _contenttypes.get(posixpath.splitext(name)[1], "application/octet-stream")
+            self.send_response(200)
+            self.send_header("Content-Type", f"{contenttype}; charset=utf-8" if contenttype.startswith("text/") else contenttype)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            log.debug(format % args)
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    log.info(f"Ready with {len(names)} files at http://{host}:{server.server_port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        archive.close()
+
+
+# Dataset sources, which are functions returning a dataset from a path, an optional sample count, and a random number generator.
+sources = {
+    "caltech101": caltech101,
+    "imagefolder": imagefolder,
+    "imagenet2012": imagenet2012,
+    "places365": places365,
+    "tarshards": tarshards,
+}
@@ -0,0 +1,239 @@
+// Copyright 2018, National Technology & Engineering Solutions of Sandia, LLC
+// (NTESS).  Under the terms of Contract DE-NA0003525 with NTESS, the U.S.
+// Government retains certain rights in this software.
+
+// Client-side viewer for deep visualizations generated with mode="shards".
+// Renders the same markup as the static page templates, fetching only the
+// shards needed for the current view.
+
+(function() {
+    "use strict";
+
+    const viewer = document.getElementById("viewer");
+    const webroot = viewer.dataset.webroot;
+    const buffers = new Map();
+    let index = null;
+    let previews = null;
+
+    function fetchBuffer(path) {
+        if (!buffers.has(path)) {
+            buffers.set(path, fetch(webroot + path).then(function(response) {
+                if (!response.ok)
+                    throw new Error(`Error loading ${path}: ${response.status}`);
+                return response.arrayBuffer();
+            }));
+        }
+        return buffers.get(path);
+    }
+
+    // Shards contain an int32 array followed by a float32 array of the same length.
+    async function fetchShard(path) {
+        const buffer = await fetchBuffer(path);
+        const count = buffer.byteLength / 8;
+        return {indices: new Int32Array(buffer, 0, count), values: new Float32Array(buffer, count * 4, count)};
+    }
+
+    function escape(text) {
+        return String(text).replace(/[&<>"']/g, (c) => ({"&": "&amp;", "<": "&lt;", ">": "&gt;", "\"": "&quot;", "'": "&#39;"})[c]);
+    }
+
+    function modulo(a, b) {
+        return ((a % b) + b) % b;
+    }
+
+    function conv(layer) {
+        return layer.conv ? `(${layer.conv.join(", ")})` : "None";
+    }
+
+    function homeurl() { return "#/"; }
+    function layerurl(layer) { return `#/layers/${layer}`; }
+    function channelurl(layer, channel) { return `#/layers/${layer}/channels/${channel}`; }
+    function dataseturl(dataset) { return `#/datasets/${dataset.slug}`; }
+    function sampleurl(dataset, sample) { return `#/datasets/${dataset.slug}/samples/${sample}`; }
+    function imageurl(dataset, sample) { return `${webroot}datasets/${dataset.slug}/samples/${sample}/image.png`; }
+    function thumbnailurl(dataset, sample) { return `${webroot}datasets/${dataset.slug}/samples/${sample}/thumbnail.${index.thumbnail}`; }
+
+    function channelname(layer, channel) {
+        return layer.channels ? layer.channels[channel] : `Channel ${channel}`;
+    }
+
+    async function category(dataset, sample) {
+        const targets = new Int32Array(await fetchBuffer(`data/datasets/${dataset.slug}/targets.bin`));
+        const target = targets[sample];
+        return {index: target, name: dataset.categories[target]};
+    }
+
+    function preview(layer, channel) {
+        if (!index.datasets.length)
+            return "";
+        const dataset = index.datasets[0];
+        let html = "";
+        for (let i = 0; i != 3; ++i) {
+            const sample = previews[layer.previewoffset + channel * 3 + i];
+            if (sample >= 0)
+                html += `<img src="${thumbnailurl(dataset, sample)}" style="width: 1.5rem" loading="lazy">`;
+        }
+        return html;
+    }
+
+    function header(parts) {
+        return `<div class="row"><span class="h1"><a href="${homeurl()}">${escape(index.title)}</a> / ${parts.join(" / ")}</span></div>`;
+    }
+
+    function navigation(prevurl, nexturl) {
+        return `<a class="btn btn-outline-secondary btn-sm" href="${prevurl}">&lt;</a> <a class="btn btn-outline-secondary btn-sm" href="${nexturl}">&gt;</a>`;
+    }
+
+    function home() {
+        let layers = "";
+        for (const layer of index.layers) {
+            layers += `<div class="card mb-2 me-2" style="min-width: 12rem"><div class="card-body">
+                <a href="${layerurl(layer.index)}"><h5 class="card-title">${escape(layer.name)}</h5></a>
+                <h6 class="card-subtitle text-body-secondary mb-2">${escape(layer.type)}</h6>
+                <ul class="list-unstyled"><li>Channels: ${layer.nchannels}</li><li>Convolution: ${conv(layer)}</li></ul>
+                </div></div>`;
+        }
+        let datasets = "";
+        for (const dataset of index.datasets) {
+            datasets += `<div class="card mb-2 me-2" style="min-width: 12rem"><div class="card-body">
+                <a href="${dataseturl(dataset)}"><h5 class="card-title">${escape(dataset.name)}</h5></a>
+                <ul class="list-unstyled"><li>Samples: ${dataset.count}</li><li>Classes: ${Object.keys(dataset.categories).length}</li></ul>
+                </div></div>`;
+        }
+        document.title = index.title;
+        return `<div class="row"><span class="h1">${escape(index.title)}</span></div>
+            <div class="row"><div class="col"><h2>Layers</h2><div class="container-fluid overflow-x-scroll"><div class="d-flex flex-row flex-nowrap">${layers}</div></div></div></div>
+            <div class="row"><div class="col"><h2>Datasets</h2><div class="container-fluid overflow-x-scroll"><div class="d-flex flex-row flex-nowrap">${datasets}</div></div></div></div>`;
+    }
+
+    function layer(layer) {
+        const count = index.layers.length;
+        let channels = "";
+        for (let channel = 0; channel != layer.nchannels; ++channel) {
+            channels += `<a href="${channelurl(layer.index, channel)}"><div class="card mb-1 me-1" style="width: 6rem"><div class="card-body" style="padding: 0.4rem">
+                <div class="card-title" style="font-size: 0.7rem" title="Channel ${channel}">${escape(channelname(layer, channel))}</div>
+                ${preview(layer, channel)}
+                </div></div></a>`;
+        }
+        document.title = `${index.title} / ${layer.name}`;
+        return header([`${escape(layer.name)} ${navigation(layerurl(modulo(layer.index - 1, count)), layerurl(modulo(layer.index + 1, count)))}`]) +
+            `<div class="row"><div class="col"><h2>Description</h2><ul class="list-unstyled">
+                <li>Type: ${escape(layer.type)}</li><li>Channels: ${layer.nchannels}</li><li>Convolution: ${conv(layer)}</li>
+            </ul></div></div>
+            <div class="row"><div class="col"><h2>Channels</h2><div class="d-flex flex-wrap">${channels}</div></div></div>`;
+    }
+
+    async function channel(layer, channel) {
+        const count = index.layers.length;
+        let activations = "";
+        for (const dataset of index.datasets) {
+            const shard = await fetchShard(`data/layers/${layer.index}/${dataset.slug}.bin`);
+            let samples = "";
+            for (let i = 0; i != dataset.examples; ++i) {
+                const sample = shard.indices[channel * dataset.examples + i];
+                const target = await category(dataset, sample);
+                samples += `<div class="card mb-1 me-1" style="min-width: 6rem">
+                    <a href="${sampleurl(dataset, sample)}"><img src="${thumbnailurl(dataset, sample)}" class="card-img-top" loading="lazy"></a>
+                    <div class="card-body">
+                        <div class="card-title" style="font-size: 0.7em">Sample ${sample}</div>
+                        <div class="card-subtitle" style="font-size: 0.7em" title="Class ${target.index}">${escape(target.name)}</div>
+                        <ul class="list-unstyled" style="font-size: 0.6em"><li>Act: ${shard.values[channel * dataset.examples + i].toFixed(3)}</li></ul>
+                    </div></div>`;
+            }
+            activations += `<h3><a href="${dataseturl(dataset)}">${escape(dataset.name)}</a></h3>
+                <div class="container-fluid overflow-x-scroll"><div class="d-flex flex-row flex-nowrap">${samples}</div></div>`;
+        }
+        document.title = `${index.title} / ${layer.name} / Channel ${channel}`;
+        return header([
+            `<a href="${layerurl(layer.index)}">${escape(layer.name)}</a> ${navigation(channelurl(modulo(layer.index - 1, count), channel), channelurl(modulo(layer.index + 1, count), channel))}`,
+            `<span title="Channel ${channel}">${escape(channelname(layer, channel))}</span> ${navigation(channelurl(layer.index, modulo(channel - 1, layer.nchannels)), channelurl(layer.index, modulo(channel + 1, layer.nchannels)))}`,
+            ]) +
+            `<div class="row"><div class="col"><h2>Description</h2><p>Displays the top <i>n</i> images from each dataset, ordered by how strongly they activate this channel.</p></div></div>
+            <div class="row"><div class="col"><h2>Activations</h2>${activations}</div></div>`;
+    }
+
+    async function dataset(dataset) {
+        let samples = "";
+        for (let sample = 0; sample != dataset.count; ++sample) {
+            const target = await category(dataset, sample);
+            samples += `<a href="${sampleurl(dataset, sample)}"><div class="card mb-1 me-1" style="width: 6rem">
+                <img src="${thumbnailurl(dataset, sample)}" class="card-img-top" loading="lazy">
+                <div class="card-body">
+                    <div class="card-title" style="font-size: 0.7rem">Sample ${sample}</div>
+                    <div class="card-subtitle" style="font-size: 0.6rem" title="Class ${target.index}">${escape(target.name)}</div>
+                </div></div></a>`;
+        }
+        document.title = index.title;
+        return header([escape(dataset.name)]) +
+            `<div class="row"><div class="col"><h2>Description</h2><ul class="list-unstyled">
+                <li>Samples: ${dataset.count}</li><li>Categories: ${Object.keys(dataset.categories).length}</li>
+            </ul></div></div>
+            <div class="row"><div class="col"><h2>Images</h2><div class="d-flex flex-wrap">${samples}</div></div></div>`;
+    }
+
+    async function sample(dataset, sample) {
+        const target = await category(dataset, sample);
+        const block = Math.floor(sample / index.blocksize);
+        const shard = await fetchShard(`data/datasets/${dataset.slug}/samples/${block}.bin`);
+        const offset = (sample - block * index.blocksize) * index.layers.length * 10;
+
+        let activations = "";
+        for (const [i, layer] of index.layers.entries()) {
+            if (!layer.nchannels)
+                continue;
+            let channels = "";
+            for (let j = 0; j != 10; ++j) {
+                const channel = shard.indices[offset + i * 10 + j];
+                if (channel < 0)
+                    continue;
+                channels += `<a href="${channelurl(layer.index, channel)}"><div class="card mb-1 me-1" style="width: 6rem"><div class="card-body" style="padding: 0.4rem">
+                    <div class="card-title" style="font-size: 0.7rem" title="Channel ${channel}">${escape(channelname(layer, channel))}</div>
+                    <ul class="list-unstyled" style="font-size: 0.6rem"><li>Act: ${shard.values[offset + i * 10 + j].toFixed(3)}</li></ul>
+                    ${preview(layer, channel)}
+                    </div></div></a>`;
+            }
+            activations += `<h3><a href="${layerurl(layer.index)}">${escape(layer.name)}</a></h3><div class="d-flex flex-wrap">${channels}</div>`;
+        }
+        document.title = `${index.title} / ${dataset.name} / Sample ${sample}`;
+        return header([`<a href="${dataseturl(dataset)}">${escape(dataset.name)}</a>`, `Sample ${sample}`]) +
+            `<div class="row">
+                <div class="col-2"><h2>Description</h2><ul class="list-unstyled"><li>${escape(target.name)}</li><li>Class ${target.index}</li></ul></div>
+                <div class="col"><h2>Image</h2><img src="${imageurl(dataset, sample)}"><h2>Activations</h2>${activations}</div>
+            </div>`;
+    }
+
+    async function route() {
+        const parts = location.hash.replace(/^#\/?/, "").split("/").filter((part) => part.length);
+        let html = null;
+        try {
+            if (parts.length == 0) {
+                html = home();
+            } else if (parts[0] == "layers" && index.layers[parts[1]]) {
+                const target = index.layers[parts[1]];
+                if (parts.length == 2)
+                    html = layer(target);
+                else if (parts[2] == "channels" && parts[3] < target.nchannels)
+                    html = await channel(target, Number(parts[3]));
+            } else if (parts[0] == "datasets") {
+                const target = index.datasets.find((dataset) => dataset.slug == parts[1]);
+                if (target && parts.length == 2)
+                    html = await dataset(target);
+                else if (target && parts[2] == "samples" && parts[3] < target.count)
+                    html = await sample(target, Number(parts[3]));
+            }
+        } catch (error) {
+            html = `<div class="row"><div class="col">${escape(error)}</div></div>`;
+        }
+        viewer.innerHTML = html === null ? `<div class="row"><div class="col">Not found.</div></div>` : html;
+        window.scrollTo(0, 0);
+    }
+
+    async function main() {
+        index = JSON.parse(new TextDecoder().decode(await fetchBuffer("data/index.json")));
+        previews = new Int32Array(await fetchBuffer("data/previews.bin"));
+        window.addEventListener("hashchange", route);
+        route();
+    }
+
+    main();
+})();